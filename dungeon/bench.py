@@ -0,0 +1,210 @@
+import io
+import os
+import sys
+import subprocess
+import tempfile
+import time
+import threading
+import contextlib
+import random
+import argparse
+import asyncio
+import ontology
+import player
+import loader
+import xml.etree.ElementTree as ET
+from scheduler import Scheduler
+
+def timeit(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def populate(room, count, size, seed=0):
+    rng = random.Random(seed)
+    scrolls = []
+    for i in range(count):
+        scroll = ontology.Scroll(rng.uniform(0, size), rng.uniform(0, size), name=f'scroll {i}')
+        scroll.owner = room
+        scrolls.append(scroll)
+    return scrolls
+
+def wander(scrolls, steps, seed=0):
+    rng = random.Random(seed)
+    for i in range(steps):
+        scroll = scrolls[rng.randrange(len(scrolls))]
+        x, y = scroll.position
+        scroll.position = (x + rng.uniform(-1, 1), y + rng.uniform(-1, 1))
+
+def scan_near(room, position, radius):
+    cx, cy = position
+    return [m for m in room.members if (m.x - cx) ** 2 + (m.y - cy) ** 2 <= radius * radius]
+
+def bench_spatial(sizes=(10**4, 10**5), steps=10**5, queries=1000, scan_queries=20, radius=10):
+    print(f'{"entities":>10} {"populate":>10} {"moves/s":>10} {"query ms":>10} {"scan ms":>10} {"rect ms":>10}')
+    for n in sizes:
+        size = (n * 100) ** 0.5  # about one entity per 10x10 square
+        room = ontology.Room(description='a huge hall')
+        scrolls = []
+        populate_seconds = timeit(lambda: scrolls.extend(populate(room, n, size)))
+        moves = steps / timeit(wander, scrolls, steps)
+        rng = random.Random(1)
+        centers = [(rng.uniform(0, size), rng.uniform(0, size)) for i in range(queries)]
+        query = timeit(lambda: [room.find_near(c, radius) for c in centers]) / queries
+        scan = timeit(lambda: [scan_near(room, c, radius) for c in centers[:scan_queries]]) / scan_queries
+        assert sorted(map(id, room.find_near(centers[0], radius))) == sorted(map(id, scan_near(room, centers[0], radius)))
+        rect = timeit(lambda: [room.find_in_rect(x, y, x + 2 * radius, y + 2 * radius) for x, y in centers]) / queries
+        print(f'{n:10} {populate_seconds:10.3f} {moves:10.0f} {query * 1e3:10.3f} {scan * 1e3:10.3f} {rect * 1e3:10.3f}')
+
+class Walker(ontology.NPC):
+    updates = 0
+
+    def __init__(self, period, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.period = period
+
+    def update(self):
+        Walker.updates += 1
+        return self.period
+
+def walkers(count, period, seed=0):
+    rng = random.Random(seed)
+    world = ontology.World()
+    for i in range(count):
+        Walker(period * rng.uniform(0.5, 1.5)).owner = world
+    return world
+
+async def run_coroutines(world, seconds):
+    tasks = [asyncio.ensure_future(c) for c in world.runnable()]
+    await asyncio.sleep(seconds)
+    ontology.END_OF_WORLD = True
+    await asyncio.gather(*tasks)
+    ontology.END_OF_WORLD = False
+
+async def run_scheduler(world, seconds, tick):
+    scheduler = Scheduler(tick)
+    world.runnable(scheduler)
+    ticks = asyncio.create_task(scheduler.run())
+    await asyncio.sleep(seconds)
+    scheduler.stop()
+    await ticks
+
+def bench_scheduler(sizes=(10**3, 10**4, 10**5), period=0.5, seconds=3.0, tick=0.05, virtual_ticks=200):
+    # NPCs per second: updates done by the event loop per second of wall time
+    print(f'{"npcs":>8} {"coroutines/s":>14} {"scheduler/s":>12} {"ticks only/s":>13}')
+    for n in sizes:
+        world = walkers(n, period)
+        Walker.updates = 0
+        elapsed = timeit(asyncio.run, run_coroutines(world, seconds))
+        coroutines = Walker.updates / elapsed
+        Walker.updates = 0
+        elapsed = timeit(asyncio.run, run_scheduler(world, seconds, tick))
+        scheduled = Walker.updates / elapsed
+        # the scheduler alone, in simulated time without waiting for the clock
+        scheduler = Scheduler(tick)
+        world.runnable(scheduler)
+        Walker.updates = 0
+        elapsed = timeit(scheduler.run_ticks, virtual_ticks)
+        print(f'{n:8} {coroutines:14.0f} {scheduled:12.0f} {Walker.updates / elapsed:13.0f}')
+
+class ScriptedPlayer(player.Player):
+    executed = ()
+
+    def precmd(self, line):
+        self.executed.append(time.perf_counter())
+        return line
+
+def type_script(stream, script, pause, sent):
+    # a slow typist: every command comes after a pause
+    for line in script:
+        time.sleep(pause)
+        sent.append(time.perf_counter())
+        stream.write(line + '\n')
+        stream.flush()
+    stream.close()
+
+async def play(world, scheduler):
+    ticks = asyncio.create_task(scheduler.run())
+    await asyncio.gather(*world.runnable(scheduler))
+    scheduler.stop()
+    await ticks
+
+def bench_input(npcs=(0, 1000, 10000), period=0.1, commands=20, pause=0.05):
+    # NPCs keep their update rate while the player is typing,
+    # and the player's commands run as soon as they are typed
+    print(f'{"npcs":>8} {"expected/s":>10} {"updates/s":>10} {"latency ms":>10}')
+    script = ['inspect a box', 'open the box', 'inspect it', 'where'] * (commands // 4) + ['bye']
+    for n in npcs:
+        world = walkers(n, period)
+        room = ontology.Room(description='a quiet hall')
+        room.owner = world
+        ontology.Box(description='a box').owner = room
+        me = ScriptedPlayer(name='tester', description='the player')
+        me.owner = room
+        read, write = os.pipe()
+        me.stdin, me.stdout = os.fdopen(read), io.StringIO()
+        me.executed, sent = [], []
+        typist = threading.Thread(target=type_script, args=(os.fdopen(write, 'w'), script, pause, sent))
+        Walker.updates = 0
+        typist.start()
+        with contextlib.redirect_stdout(io.StringIO()):
+            elapsed = timeit(asyncio.run, play(world, Scheduler(period / 2)))
+        typist.join()
+        ontology.END_OF_WORLD = False
+        assert len(me.executed) == len(script)
+        assert n == 0 or Walker.updates > n * (elapsed / period) / 2, 'NPCs stalled while the player was typing'
+        latency = sum(done - typed for done, typed in zip(me.executed, sent)) / len(sent)
+        print(f'{n:8} {n / period:10.0f} {Walker.updates / elapsed:10.0f} {latency * 1e3:10.2f}')
+
+def generate_world(path, rooms, items):
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write('<?xml version="1.0" encoding="utf-8"?>\n<World>\n')
+        for i in range(rooms):
+            f.write(f'  <Room description="room {i}" x="{i}" y="0">\n')
+            for j in range(items // 2):
+                f.write(f'    <Box description="box {j}" x="{j}" y="{i}"><Scroll description="scroll {j}" /></Box>\n')
+            if i == 0:
+                f.write('    <Player name="John Random" description="the player" />\n')
+            f.write('  </Room>\n')
+        f.write('  <Troll name="Grkr" description="a nasty troll" />\n</World>\n')
+
+def load_world(method, path):
+    if method == 'parse':
+        return ontology.World.fromxml(ET.parse(path).getroot())
+    return loader.load(path, lazy=method == 'lazy')
+
+def measure_load(method, path):
+    # run in a fresh process, since the peak RSS of a process never goes down
+    script = (f'import bench, resource, time; start = time.perf_counter(); '
+              f'bench.load_world({method!r}, {path!r}); seconds = time.perf_counter() - start; '
+              f'print(seconds, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)')
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    seconds, rss = output.split()
+    return float(seconds), int(rss)
+
+def bench_load(sizes=((100, 100), (1000, 100), (1000, 1000))):
+    print(f'{"nodes":>9} {"MB":>6} {"parse s":>8} {"parse MB":>8} {"stream s":>8} {"stream MB":>9} '
+          f'{"lazy s":>8} {"lazy MB":>8}')
+    with tempfile.TemporaryDirectory() as directory:
+        for rooms, items in sizes:
+            path = os.path.join(directory, 'world.xml')
+            generate_world(path, rooms, items)
+            results = []
+            for method in ('parse', 'stream', 'lazy'):
+                seconds, rss = measure_load(method, path)
+                results.append(f'{seconds:8.2f} {rss / 1024:8.0f}')
+            print(f'{rooms * (items + 1):9} {os.path.getsize(path) / 2**20:6.1f} {" ".join(results)}')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmarks for the dungeon world')
+    parser.add_argument('--large', action='store_true', help='also run with a million entities')
+    args = parser.parse_args(argv)
+    bench_spatial(sizes=(10**4, 10**5, 10**6) if args.large else (10**4, 10**5))
+    bench_scheduler(sizes=(10**3, 10**4, 10**5, 10**6) if args.large else (10**3, 10**4, 10**5))
+    bench_input()
+    bench_load(((100, 100), (1000, 100), (1000, 1000)) if args.large else ((100, 100), (1000, 100)))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
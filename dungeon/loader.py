@@ -0,0 +1,72 @@
+import os
+import functools
+import xml.parsers.expat
+import ontology
+
+def read_fragment(path, encoding, tag, start, end):
+    with open(path, 'rb') as f:
+        f.seek(start)
+        data = f.read(end - start)
+    # the fragment has no xml declaration of its own, so it is decoded here,
+    # and it stops right before the closing tag
+    return data.decode(encoding) + f'</{tag}>'
+
+def load(source, lazy=False):
+    # builds the world while streaming the xml: entities are created on start
+    # tags and no element tree is kept; with lazy=True a room without a player
+    # only remembers where its contents are in the file, and they are built
+    # when a player first enters the room
+    if lazy and not isinstance(source, (str, os.PathLike)):
+        raise ValueError('lazy loading needs a file name to read rooms from later')
+    parser = xml.parsers.expat.ParserCreate()
+    entities = []
+    roots = []
+    skipped = None
+    encoding = 'utf-8'
+
+    def declaration(version, declared, standalone):
+        nonlocal encoding
+        if declared:
+            encoding = declared
+
+    def start(tag, attrib):
+        nonlocal skipped
+        if skipped is not None:
+            skipped[3] += 1
+            skipped[4] = skipped[4] or tag == 'Player'
+            skipped[5] = True
+            return
+        entity = ontology.Entity.ENTITIES[tag](**attrib)
+        if entities:
+            entity.owner = entities[-1]
+        else:
+            roots.append(entity)
+        entities.append(entity)
+        if lazy and isinstance(entity, ontology.Room):
+            skipped = [entity, tag, parser.CurrentByteIndex, 0, False, False]
+
+    def end(tag):
+        nonlocal skipped
+        if skipped is not None:
+            if skipped[3] > 0:
+                skipped[3] -= 1
+                return
+            room, tag, offset, depth, has_player, has_children = skipped
+            skipped = None
+            # an empty room (<Room/> included) has nothing to build later
+            if has_children:
+                room.defer(functools.partial(read_fragment, source, encoding, tag, offset,
+                                             parser.CurrentByteIndex))
+                if has_player:
+                    room.materialize()
+        entities.pop()
+
+    parser.XmlDeclHandler = declaration
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    if isinstance(source, (str, os.PathLike)):
+        with open(source, 'rb') as f:
+            parser.ParseFile(f)
+    else:
+        parser.ParseFile(source)
+    return roots[0]
@@ -1,12 +1,16 @@
 import ontology
 import player
-import xml.etree.ElementTree as ET
+import loader
 import asyncio
+from scheduler import Scheduler
 
-input = ET.parse('example.xml')
-world = ontology.World.fromxml(input.getroot())
+world = loader.load('example.xml', lazy=True)
 
 async def main():
-    await asyncio.gather(*world.runnable())
+    scheduler = Scheduler()
+    ticks = asyncio.create_task(scheduler.run())
+    await asyncio.gather(*world.runnable(scheduler))
+    scheduler.stop()
+    await ticks
 
 asyncio.run(main())
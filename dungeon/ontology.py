@@ -1,12 +1,22 @@
 import asyncio
+import math
+import numbers
+import xml.etree.ElementTree as ET
 
 END_OF_WORLD = False
 
+def coordinate(value):
+    # coordinates read from xml attributes are strings
+    if isinstance(value, str):
+        value = float(value)
+        return int(value) if value.is_integer() else value
+    return value
+
 class Entity:
     ENTITIES = {}
 
     def __init__(self, x=0, y=0, name="", description="", owner=None):
-        self._position = (x, y)
+        self._position = (coordinate(x), coordinate(y))
         self._label = name
         self._description = description
         self._owner = owner
@@ -35,6 +45,12 @@ class Entity:
     def label(self):
         return self._label
 
+    @label.setter
+    def label(self, new_label):
+        if self._owner is not None:
+            self._owner.relabel(self, new_label)
+        self._label = new_label
+
     @property
     def description(self):
         return self._description
@@ -73,39 +89,223 @@ class Entity:
             subobj.owner = newobj
         return newobj
 
-    def runnable(self):
+    def runnable(self, scheduler=None):
         return ()
 
 class Container:
     def __init__(self, members=()):
-        self._members = set(members)
+        self._members = set()
+        self._by_kind = {}
+        self._by_label = {}
+        self._containers = set()
+        for member in members:
+            self.enter(member)
 
     def enter(self, new_member):
         if new_member is self:
             raise ValueError('an object cannot be put to itself')
+        if new_member in self._members:
+            return
         self._members.add(new_member)
+        self._by_kind.setdefault(new_member.kind, set()).add(new_member)
+        self._by_label.setdefault(new_member.label, set()).add(new_member)
+        if isinstance(new_member, Container):
+            self._containers.add(new_member)
 
     def leave(self, member):
+        if member not in self._members:
+            return
         self._members.discard(member)
+        self._unindex(self._by_kind, member.kind, member)
+        self._unindex(self._by_label, member.label, member)
+        self._containers.discard(member)
+
+    def relabel(self, member, new_label):
+        if member in self._members:
+            self._unindex(self._by_label, member.label, member)
+            self._by_label.setdefault(new_label, set()).add(member)
+
+    @staticmethod
+    def _unindex(index, key, member):
+        bucket = index.get(key)
+        if bucket is not None:
+            bucket.discard(member)
+            if not bucket:
+                del index[key]
 
     @property
     def members(self):
         return self._members
 
+    def allow_move(self, member, new_pos):
+        pass
+
+    def find_by_kind(self, kind, nested=False):
+        return self._find('_by_kind', kind, nested)
+
+    def find_by_label(self, label, nested=False):
+        return self._find('_by_label', label, nested)
+
+    def _find(self, index, key, nested):
+        found = list(getattr(self, index).get(key, ()))
+        if nested:
+            # only the contents of open boxes are visible
+            for container in self._containers:
+                if getattr(container, 'is_open', False):
+                    found += container._find(index, key, nested)
+        return found
+
+class SpatialIndex:
+    def __init__(self, cell=16):
+        self._cell = cell
+        self._cells = {}
+        self._keys = {}
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, entity):
+        return entity in self._keys
+
+    def _key(self, position):
+        x, y = position
+        return (math.floor(x / self._cell), math.floor(y / self._cell))
+
+    def add(self, entity, position):
+        key = self._key(position)
+        self._keys[entity] = key
+        self._cells.setdefault(key, set()).add(entity)
+
+    def remove(self, entity):
+        key = self._keys.pop(entity, None)
+        if key is not None:
+            bucket = self._cells[key]
+            bucket.discard(entity)
+            if not bucket:
+                del self._cells[key]
+
+    def move(self, entity, position):
+        key = self._key(position)
+        old = self._keys.get(entity)
+        if old == key:
+            return
+        if old is not None:
+            self.remove(entity)
+        self._keys[entity] = key
+        self._cells.setdefault(key, set()).add(entity)
+
+    def _candidates(self, x0, y0, x1, y1):
+        kx0, ky0 = self._key((x0, y0))
+        kx1, ky1 = self._key((x1, y1))
+        if (kx1 - kx0 + 1) * (ky1 - ky0 + 1) > len(self._cells):
+            # a large area covers fewer occupied cells than cells in range
+            for (kx, ky), bucket in self._cells.items():
+                if kx0 <= kx <= kx1 and ky0 <= ky <= ky1:
+                    yield from bucket
+            return
+        for kx in range(kx0, kx1 + 1):
+            for ky in range(ky0, ky1 + 1):
+                bucket = self._cells.get((kx, ky))
+                if bucket:
+                    yield from bucket
+
+    def in_rect(self, x0, y0, x1, y1):
+        found = []
+        for entity in self._candidates(x0, y0, x1, y1):
+            x, y = entity.position
+            if x0 <= x <= x1 and y0 <= y <= y1:
+                found.append(entity)
+        return found
+
+    def in_radius(self, center, radius):
+        cx, cy = center
+        limit = radius * radius
+        found = []
+        for entity in self._candidates(cx - radius, cy - radius, cx + radius, cy + radius):
+            x, y = entity.position
+            if (x - cx) * (x - cx) + (y - cy) * (y - cy) <= limit:
+                found.append(entity)
+        return found
+
 class Scene(Container, Entity):
     
     def __init__(self, *args, **kwargs):
+        self._spatial = SpatialIndex()
         super().__init__(())
         super(Container, self).__init__(*args, **kwargs)
 
-    def runnable(self):
+    def enter(self, new_member):
+        super().enter(new_member)
+        self._spatial.add(new_member, new_member.position)
+
+    def leave(self, member):
+        super().leave(member)
+        self._spatial.remove(member)
+
+    def allow_move(self, member, new_pos):
+        if len(new_pos) != 2 or not all(isinstance(c, numbers.Real) for c in new_pos):
+            raise ValueError(f'invalid position: {new_pos!r}')
+        self._spatial.move(member, new_pos)
+
+    def find_near(self, position, radius):
+        if isinstance(position, Entity):
+            position = position.position
+        return self._spatial.in_radius(position, radius)
+
+    def find_in_rect(self, x0, y0, x1, y1):
+        return self._spatial.in_rect(x0, y0, x1, y1)
+
+    def runnable(self, scheduler=None):
         children = []
         for c in self.members:
-            children += c.runnable()
+            children += c.runnable(scheduler)
         return children
 
 class Room(Scene):
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pending = None
+        self._scheduler = None
+        self._started = False
+
+    def defer(self, read):
+        # read() returns the xml of the room, its contents are built from it
+        # when a player first enters
+        self._pending = read
+
+    @property
+    def loaded(self):
+        return self._pending is None
+
+    def materialize(self):
+        if self._pending is None:
+            return []
+        node = ET.fromstring(self._pending())
+        self._pending = None
+        contents = []
+        for child in node:
+            entity = Entity.fromxml(child)
+            entity.owner = self
+            contents.append(entity)
+        if self._started:
+            # the world is already running, so the new entities join it
+            loop = asyncio.get_running_loop()
+            for entity in contents:
+                for coroutine in entity.runnable(self._scheduler):
+                    loop.create_task(coroutine)
+        return contents
+
+    def enter(self, new_member):
+        if self._pending is not None and new_member.kind == 'player':
+            self.materialize()
+        super().enter(new_member)
+
+    def runnable(self, scheduler=None):
+        self._started = True
+        self._scheduler = scheduler
+        return super().runnable(scheduler)
+
     @property
     def description(self):
         descr = super().description
@@ -154,21 +354,32 @@ class Scroll(PhysicalEntity):
 Scroll.register()
 
 class ActiveEntity(PhysicalEntity):
-
-    def runnable(self):
+    # tick-based entities define update(), which returns the delay in seconds
+    # until the next update or None; they run on a scheduler if one is given
+    update = None
+
+    def runnable(self, scheduler=None):
+        if scheduler is not None and self.update is not None:
+            scheduler.add(self)
+            return ()
         return (self.behaviour(),)
 
     async def behaviour(self):
-        pass
+        if self.update is None:
+            return
+        while not END_OF_WORLD:
+            delay = self.update()
+            if delay is None:
+                return
+            await asyncio.sleep(delay)
 
 class NPC(ActiveEntity):
     pass
 
 class Troll(NPC):
 
-    async def behaviour(self):
-        while not END_OF_WORLD:
-            print('Rrrr! Rrrr! Rrrrr!')
-            await asyncio.sleep(5)
+    def update(self):
+        print('Rrrr! Rrrr! Rrrrr!')
+        return 5
 
 Troll.register()
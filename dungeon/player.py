@@ -3,6 +3,7 @@ import cmd
 import shlex
 import itertools
 import asyncio
+import threading
 import sys
 
 class Player(ontology.Container, cmd.Cmd, ontology.ActiveEntity):
@@ -22,11 +23,14 @@ class Player(ontology.Container, cmd.Cmd, ontology.ActiveEntity):
 
         return " ".join(prefix), suffix
 
+    # the player also sees what lies in open boxes, carried or around
     def _find_by_kind(self, name):
-        return [ obj for obj in self.members | self.owner.members | {self.owner} if obj.kind == name ]
+        found = self.find_by_kind(name, nested=True) + self.owner.find_by_kind(name, nested=True)
+        return found + [self.owner] if self.owner.kind == name else found
 
     def _find_by_label(self, name):
-        return [ obj for obj in self.members | self.owner.members | {self.owner} if obj.label == name ]
+        found = self.find_by_label(name, nested=True) + self.owner.find_by_label(name, nested=True)
+        return found + [self.owner] if self.owner.label == name else found
 
     def _parse(self, args):
         head, *rest = args
@@ -95,6 +99,10 @@ class Player(ontology.Container, cmd.Cmd, ontology.ActiveEntity):
         ontology.END_OF_WORLD = True
         return True
 
+    def do_EOF(self, line):
+        """End the game"""
+        return self.do_bye(line)
+
     def do_where(self, line):
         """Where am I?"""
         print(self.owner.description)
@@ -102,14 +110,48 @@ class Player(ontology.Container, cmd.Cmd, ontology.ActiveEntity):
     def emptyline(self):
         return True
         
-    async def behaviour(self):
-        while not ontology.END_OF_WORLD:
+    async def readline(self):
+        # the blocking read runs in a daemon thread, so the event loop keeps
+        # running the other entities while the player types, and an interrupted
+        # game does not wait for the pending read
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def deliver(line):
+            if not future.done():
+                future.set_result(line)
+
+        def read():
+            line = self.stdin.readline()
+            try:
+                loop.call_soon_threadsafe(deliver, line)
+            except RuntimeError:
+                pass
+
+        threading.Thread(target=read, daemon=True).start()
+        line = await future
+        return line.rstrip('\r\n') if line else 'EOF'
+
+    async def acmdloop(self):
+        self.preloop()
+        stop = None
+        while not stop:
+            if self.cmdqueue:
+                line = self.cmdqueue.pop(0)
+            else:
+                self.stdout.write(self.prompt)
+                self.stdout.flush()
+                line = await self.readline()
             try:
-                self.cmdloop()
+                line = self.precmd(line)
+                stop = self.onecmd(line)
+                stop = self.postcmd(stop, line)
             except Exception as exc:
                 print(str(exc), file=sys.stderr)
-            except KeyboardInterrupt:
-                pass
-            await asyncio.sleep(0)
+        self.postloop()
+
+    async def behaviour(self):
+        while not ontology.END_OF_WORLD:
+            await self.acmdloop()
 
 Player.register()
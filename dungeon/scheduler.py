@@ -0,0 +1,157 @@
+import asyncio
+import math
+
+class Timer:
+    __slots__ = ('deadline', 'callback', 'args', 'bucket', 'cancelled')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.bucket = None
+        self.cancelled = False
+
+    def cancel(self):
+        # a timer already taken out as due is only marked, step() skips it
+        self.cancelled = True
+        if self.bucket is not None:
+            del self.bucket[self]
+            self.bucket = None
+
+    @property
+    def active(self):
+        return self.bucket is not None
+
+class TimerWheel:
+    # a hierarchical timer wheel: level L holds the timers whose deadline
+    # shares all digits above L (in base `slots`) with the current tick,
+    # they move one level down each time the digit L of the current tick changes
+    def __init__(self, slots=64, levels=4):
+        self.slots = slots
+        self.levels = levels
+        self.now = 0
+        self._wheels = [[{} for i in range(slots)] for level in range(levels)]
+        self._overflow = {}
+        self._due = {}
+
+    def __len__(self):
+        return sum(len(bucket) for wheel in self._wheels for bucket in wheel) + len(self._overflow) + len(self._due)
+
+    def schedule(self, delay, callback, *args):
+        timer = Timer(self.now + max(1, delay), callback, args)
+        self._place(timer)
+        return timer
+
+    def _place(self, timer):
+        deadline = timer.deadline
+        if deadline <= self.now:
+            bucket = self._due
+        else:
+            bucket = self._overflow
+            span = 1
+            for wheel in self._wheels:
+                if deadline // (span * self.slots) == self.now // (span * self.slots):
+                    bucket = wheel[deadline // span % self.slots]
+                    break
+                span *= self.slots
+        bucket[timer] = None
+        timer.bucket = bucket
+
+    def _cascade(self, bucket):
+        timers = list(bucket)
+        bucket.clear()
+        for timer in timers:
+            self._place(timer)
+
+    def advance(self):
+        self.now += 1
+        level = 0
+        span = self.slots
+        while level < self.levels and self.now % span == 0:
+            level += 1
+            span *= self.slots
+        if level == self.levels:
+            self._cascade(self._overflow)
+        for l in range(min(level, self.levels - 1), 0, -1):
+            span = self.slots ** l
+            self._cascade(self._wheels[l][self.now // span % self.slots])
+        self._cascade(self._wheels[0][self.now % self.slots])
+        due = list(self._due)
+        self._due.clear()
+        for timer in due:
+            timer.bucket = None
+        return due
+
+class Scheduler:
+    # runs the updates of tick-based entities (those that define update(),
+    # returning the delay in seconds until their next update, or None to stop)
+    def __init__(self, tick=0.1, slots=64, levels=4):
+        self.tick = tick
+        self.wheel = TimerWheel(slots, levels)
+        self.updates = 0
+        self._timers = {}
+        self._stop = asyncio.Event()
+
+    def call_later(self, delay, callback, *args):
+        return self.wheel.schedule(math.ceil(delay / self.tick), callback, *args)
+
+    def add(self, entity, delay=0):
+        self.remove(entity)
+        self._schedule(entity, delay)
+
+    def remove(self, entity):
+        timer = self._timers.pop(entity, None)
+        if timer is not None:
+            timer.cancel()
+
+    def _wake(self, timer, entity):
+        if self._timers.get(entity) is not timer:
+            return
+        self.updates += 1
+        delay = entity.update()
+        if self._timers.get(entity) is not timer:
+            # the entity was removed or added again during its own update
+            return
+        if delay is None:
+            del self._timers[entity]
+        else:
+            self._schedule(entity, delay)
+
+    def _schedule(self, entity, delay):
+        timer = self.call_later(delay, self._wake, None, entity)
+        timer.args = (timer, entity)
+        self._timers[entity] = timer
+
+    def step(self):
+        timers = self.wheel.advance()
+        count = 0
+        for timer in timers:
+            if not timer.cancelled:
+                timer.callback(*timer.args)
+                count += 1
+        return count
+
+    def run_ticks(self, count):
+        for i in range(count):
+            self.step()
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        start = loop.time() - self.wheel.now * self.tick
+        try:
+            while not self._stop.is_set():
+                # ticks missed while the loop was busy are caught up in a batch,
+                # but an overloaded scheduler still gives the loop a chance to run
+                due = math.floor((loop.time() - start) / self.tick)
+                while self.wheel.now < due:
+                    self.step()
+                delay = start + (self.wheel.now + 1) * self.tick - loop.time()
+                try:
+                    await asyncio.wait_for(self._stop.wait(), max(0, delay))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            self._stop.clear()
+
+    def stop(self):
+        self._stop.set()
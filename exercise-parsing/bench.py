@@ -0,0 +1,307 @@
+import sys
+import time
+import argparse
+import random
+import functools
+import operator
+import tracemalloc
+import itertools
+from nlparse import Constituent, SpanConstituent, PackratCache, S, N, Adj, NP, NP0, V, Compl, \
+    FilterValidArticle, Features, Profile, TagParser, SeqParser, AgreementParser, word, whole, recursive, optimize
+from corpus import CorpusParser, read_tokens, split_sentences
+
+ADJECTIVES = ['quick', 'brown', 'table', 'caught', 'adorable']
+
+def timeit(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def adjective_chain(n):
+    return ['the'] + [ADJECTIVES[i % len(ADJECTIVES)] for i in range(n)] + ['fox', 'jumped']
+
+def story(n):
+    return ['the', 'quick', 'table', 'caught'] * n
+
+def bench_packrat(sizes=(50, 200, 800), clauses=(4, 8, 12, 40), backtracking_limit=12):
+    sentence = whole(S)
+    cache = PackratCache()
+    print(f'{"adjectives":>10} {"plain":>10} {"packrat":>10} {"entries":>10}')
+    for n in sizes:
+        tokens = adjective_chain(n)
+        plain = timeit(lambda: list(sentence(tokens)))
+        packrat = timeit(lambda: list(sentence(tokens, packrat=cache)))
+        print(f'{n:10} {plain:10.4f} {packrat:10.4f} {len(cache):10}')
+
+    # an optional closing period makes the plain engine parse every suffix twice
+    text = whole(recursive(lambda X: S + X + word('.') | S + X | S))
+    print(f'{"clauses":>10} {"plain":>10} {"packrat":>10} {"hits":>10}')
+    for n in clauses:
+        tokens = story(n)
+        plain = timeit(lambda: list(text(tokens))) if n <= backtracking_limit else float('nan')
+        packrat = timeit(lambda: list(text(tokens, packrat=cache)))
+        print(f'{n:10} {plain:10.4f} {packrat:10.4f} {cache.hits:10}')
+
+def bench_chart(clauses=(4, 12, 40, 100), sizes=(50, 200, 800), backtracking_limit=12):
+    text = whole(recursive(lambda X: S + X + word('.') | S + X | S))
+    print(f'{"clauses":>10} {"plain":>10} {"packrat":>10} {"chart":>10}')
+    for n in clauses:
+        tokens = story(n)
+        plain = timeit(lambda: list(text(tokens))) if n <= backtracking_limit else float('nan')
+        packrat = timeit(lambda: list(text(tokens, packrat=True)))
+        chart = timeit(lambda: list(text(tokens, engine='chart')))
+        print(f'{n:10} {plain:10.4f} {packrat:10.4f} {chart:10.4f}')
+
+    # a left-recursive rule loops forever on the combinators and only parses on the chart
+    right = whole(recursive(lambda NP0: (N | Adj + NP0) @ 'NP'))
+    left = whole(recursive(lambda NP0: (N | NP0 + N) @ 'NP'))
+    print(f'{"words":>10} {"right":>10} {"chart":>10} {"left":>10}')
+    for n in sizes:
+        tokens = adjective_chain(n)[1:-1]
+        nouns = ['fox'] * n
+        plain = timeit(lambda: list(right(tokens)))
+        chart = timeit(lambda: list(right(tokens, engine='chart')))
+        recursive_left = timeit(lambda: list(left(nouns, engine='chart')))
+        print(f'{n:10} {plain:10.4f} {chart:10.4f} {recursive_left:10.4f}')
+
+def bench_forest(sizes=(8, 12, 16, 50, 100), filtered_sizes=(8, 12, 16, 50, 100), enumerate_limit=12, k=10):
+    # every split of a run of nouns into noun phrases is a separate parse
+    compound = whole(recursive(lambda X: NP0 + X | NP0))
+    print(f'{"words":>6} {"trees":>12} {"nodes":>8} {"enumerate":>10} {"forest":>10} {"first k":>10} {"unrank":>10}')
+    for n in sizes:
+        tokens = ['table'] * n
+        enumerate_all = timeit(lambda: list(compound(tokens))) if n <= enumerate_limit else float('nan')
+        forest = compound.forest(tokens)
+        build = timeit(compound.forest, tokens)
+        first = timeit(forest.first, k)
+        unrank = timeit(forest.tree, forest.count() // 2)
+        print(f'{n:6} {forest.count():12.3g} {len(forest):8} {enumerate_all:10.4f} {build:10.4f} '
+              f'{first:10.4f} {unrank:10.4f}')
+
+    # the article filter decides each packed alternative, so the count needs no enumeration
+    mixed = whole(recursive(lambda X: NP + X | NP0 + X | NP | NP0))
+    print(f'{"words":>6} {"trees":>12} {"enumerate":>10} {"count":>10}')
+    for n in filtered_sizes:
+        tokens = ['the', 'table', 'an', 'ant', 'a', 'table'] + ['table'] * (n - 6)
+        count = timeit(lambda: mixed.forest(tokens).count())
+        forest = mixed.forest(tokens)
+        if n <= enumerate_limit:
+            trees = list(forest.trees())
+            assert forest.count() == len(trees)
+            assert [str(forest.tree(i)[0]) for i in range(len(trees))] == [str(c) for c, end in trees]
+            enumerate_all = timeit(lambda: list(mixed(tokens)))
+        else:
+            enumerate_all = float('nan')
+        print(f'{n:6} {forest.count():12.3g} {enumerate_all:10.4f} {count:10.4f}')
+
+def traced(func, *args):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, seconds, peak
+
+def build_words(tokens):
+    # the shape NP0 builds: (Adj + (Adj + ... N)) relabelled at every level
+    node = Constituent(words=(tokens[-1],)) @ 'N'
+    for w in reversed(tokens[:-1]):
+        node = (Constituent(words=(w,)) @ 'Adj' + node) @ 'NP'
+    return node
+
+def build_spans(tokens):
+    node = SpanConstituent(tokens, len(tokens) - 1, len(tokens)) @ 'N'
+    for i in range(len(tokens) - 2, -1, -1):
+        node = (SpanConstituent(tokens, i, i + 1) @ 'Adj' + node) @ 'NP'
+    return node
+
+def bench_constituent(sizes=(100, 400, 1600, 6400), parse_sizes=(200, 800, 1600)):
+    print(f'{"words":>6} {"tuple s":>10} {"tuple KB":>10} {"span s":>10} {"span KB":>10}')
+    for n in sizes:
+        tokens = tuple(adjective_chain(n)[1:-1])
+        words, tuple_seconds, tuple_peak = traced(build_words, tokens)
+        spans, span_seconds, span_peak = traced(build_spans, tokens)
+        assert words.words == spans.words
+        print(f'{n:6} {tuple_seconds:10.4f} {tuple_peak / 1024:10.0f} {span_seconds:10.4f} {span_peak / 1024:10.0f}')
+    sentence = whole(S)
+    print(f'{"words":>6} {"parse s":>10} {"words/s":>10}')
+    for n in parse_sizes:
+        tokens = adjective_chain(n)
+        seconds = timeit(lambda: list(sentence(tokens)))
+        print(f'{n:6} {seconds:10.4f} {len(tokens) / seconds:10.0f}')
+
+def lexicon_grammar(size):
+    nouns = [f'noun{i}' for i in range(size)] + ['fox', 'table']
+    adjectives = [f'adj{i}' for i in range(size)] + ['quick', 'table']
+    noun = functools.reduce(operator.or_, map(word, nouns)) @ 'N'
+    adjective = functools.reduce(operator.or_, map(word, adjectives)) @ 'Adj'
+    phrase = FilterValidArticle(Compl + recursive(lambda NP0: (noun | adjective + NP0) @ 'NP')) @ 'NP'
+    return whole((phrase + V @ 'VP') @ 'S'), nouns, adjectives
+
+def lexicon_sentences(nouns, adjectives, count, seed=0):
+    rng = random.Random(seed)
+    return [['the'] + rng.sample(adjectives, 3) + [rng.choice(nouns), 'jumped'] for i in range(count)]
+
+def bench_lexicon(sizes=(100, 1000, 3000, 30000), count=200, plain_limit=3000):
+    print(f'{"lexicon":>8} {"plain/s":>10} {"optimized/s":>12} {"optimize s":>10}')
+    for size in sizes:
+        sentence, nouns, adjectives = lexicon_grammar(size)
+        sentences = lexicon_sentences(nouns, adjectives, count)
+        optimized = optimize(sentence)
+        build = timeit(optimize, sentence)
+        plain = float('nan')
+        if size <= plain_limit:
+            assert [str(c) for c, _ in optimized(sentences[0])] == [str(c) for c, _ in sentence(sentences[0])]
+            plain = count / timeit(lambda: [list(sentence(t)) for t in sentences])
+        fast = count / timeit(lambda: [list(optimized(t)) for t in sentences])
+        print(f'{2 * size:8} {plain:10.0f} {fast:12.0f} {build:10.4f}')
+
+class DictTagParser(TagParser):
+    # the straightforward version: dict tags, merged and compared as dicts
+
+    def __init__(self, p, tag):
+        super().__init__(None, p)
+        self.tag = tag
+
+    def parse(self, state, pos):
+        for c, pos1 in state.call(self.p, pos):
+            tag = dict(c.tag, pos=self.tag) if isinstance(c.tag, dict) and isinstance(self.tag, str) else self.tag
+            c = c @ None
+            c.tag = tag
+            yield (c, pos1)
+
+class DictAgreementParser(SeqParser):
+
+    def __init__(self, feature, p1, p2):
+        super().__init__(p1, p2)
+        self.feature = feature
+
+    def parse(self, state, pos):
+        for c1, pos1 in state.call(self.p1, pos):
+            v1 = c1.tag.get(self.feature) if isinstance(c1.tag, dict) else None
+            for c2, pos2 in state.call(self.p2, pos1):
+                v2 = c2.tag.get(self.feature) if isinstance(c2.tag, dict) else None
+                if v1 is None or v2 is None or v1 == v2:
+                    c = c1 + c2
+                    c.tag = {self.feature: v1 if v1 is not None else v2}
+                    yield (c, pos2)
+
+def agreement_grammar(size, tag, agree):
+    def lexicon(words):
+        return optimize(functools.reduce(operator.or_, map(word, words)))
+    singular = [f'noun{i}' for i in range(size)] + ['fox', 'sheep']
+    plural = [f'noun{i}s' for i in range(size)] + ['foxes', 'sheep']
+    adjectives = [f'adj{i}' for i in range(size)] + ['quick']
+    noun = tag(lexicon(singular), {'pos': 'N', 'number': 'Sg'}) | tag(lexicon(plural), {'pos': 'N', 'number': 'Pl'})
+    adjective = tag(lexicon(adjectives), {'pos': 'Adj', 'number': 'Sg'}) | \
+        tag(lexicon(adjectives), {'pos': 'Adj', 'number': 'Pl'}) | tag(word('many'), {'pos': 'Adj', 'number': 'Pl'})
+    article = tag(word('a') | word('the'), {'pos': 'Compl', 'number': 'Sg'}) | \
+        tag(word('the'), {'pos': 'Compl', 'number': 'Pl'})
+    verb = tag(word('jump'), {'pos': 'V', 'number': 'Pl'}) | tag(word('jumps'), {'pos': 'V', 'number': 'Sg'}) | \
+        tag(word('jumped'), {'pos': 'V', 'number': 'Sg'}) | tag(word('jumped'), {'pos': 'V', 'number': 'Pl'})
+    phrase0 = recursive(lambda NP0: tag(noun | agree('number', adjective, NP0), 'NP'))
+    phrase = tag(agree('number', article, phrase0), 'NP')
+    return whole(tag(agree('number', phrase, verb), 'S')), singular, plural, adjectives
+
+def agreement_sentences(singular, plural, adjectives, count, seed=0):
+    rng = random.Random(seed)
+    sentences = []
+    for i in range(count):
+        plural_number = rng.random() < 0.5
+        sentences.append([rng.choice(['the'] if plural_number else ['a', 'the'])] +
+                         rng.sample(adjectives, rng.randrange(4)) +
+                         [rng.choice(plural if plural_number else singular),
+                          rng.choice(['jump', 'jumped', 'jumps'])])
+    return sentences
+
+def agree_dicts(pairs, feature):
+    merged = 0
+    for t1, t2 in pairs:
+        v1, v2 = t1.get(feature), t2.get(feature)
+        if v1 is None or v2 is None or v1 == v2:
+            merged += len({feature: v1 if v1 is not None else v2})
+    return merged
+
+def agree_bits(pairs, feature):
+    mask = Features.MASKS[feature]
+    interned = Features.INTERNED
+    merged = 0
+    for t1, t2 in pairs:
+        x, y = t1.bits & mask, t2.bits & mask
+        common = x & y
+        if common or not x or not y:
+            merged += (interned.get(common or x | y) or Features(common or x | y)).bits != 0
+    return merged
+
+def bench_agreement(sizes=(100, 10000), count=2000, pairs=200000):
+    # the check itself: compare and merge one feature of two tags
+    tags = [{'pos': pos, 'number': number} for pos in ('N', 'Adj', 'V') for number in ('Sg', 'Pl')]
+    rng = random.Random(0)
+    dict_pairs = [(rng.choice(tags), rng.choice(tags)) for i in range(pairs)]
+    bit_pairs = [(Features.make(t1), Features.make(t2)) for t1, t2 in dict_pairs]
+    assert agree_dicts(dict_pairs, 'number') == agree_bits(bit_pairs, 'number')
+    print(f'{"pairs":>8} {"dicts s":>10} {"bits s":>10}')
+    print(f'{pairs:8} {timeit(agree_dicts, dict_pairs, "number"):10.4f} {timeit(agree_bits, bit_pairs, "number"):10.4f}')
+    # whole sentences, where the combinators dominate
+    print(f'{"lexicon":>8} {"parses":>8} {"dicts/s":>10} {"bits/s":>10}')
+    for size in sizes:
+        features, singular, plural, adjectives = agreement_grammar(size, lambda p, t: p @ t, AgreementParser)
+        dicts = agreement_grammar(size, DictTagParser, DictAgreementParser)[0]
+        sentences = agreement_sentences(singular, plural, adjectives, count)
+        parses = sum(len(list(features(t))) for t in sentences)
+        assert parses == sum(len(list(dicts(t))) for t in sentences)
+        dict_rate = count / timeit(lambda: [list(dicts(t)) for t in sentences])
+        bit_rate = count / timeit(lambda: [list(features(t)) for t in sentences])
+        print(f'{3 * size:8} {parses:8} {dict_rate:10.0f} {bit_rate:10.0f}')
+
+def corpus_grammar():
+    # a factory, so that every worker process builds its own grammar with lambdas
+    return optimize(lexicon_grammar(1000)[0])
+
+def bench_corpus(workers=(0, 1, 2, 4), count=20000, path='../exercise-pandas/text.csv'):
+    nouns, adjectives = lexicon_grammar(1000)[1:]
+    sentences = lexicon_sentences(nouns, adjectives, count)
+    print(f'{"workers":>8} {"parsed":>8} {"sentences/s":>12}')
+    for n in workers:
+        # tokens are streamed into sentences and batches as the workers consume them
+        text = itertools.chain.from_iterable(s + ['.'] for s in sentences)
+        corpus = CorpusParser(corpus_grammar, workers=n, batch=256, timeout=1.0)
+        parsed = sum(1 for tokens, parses in corpus(split_sentences(text)) if parses)
+        print(f'{n:8} {parsed:8} {corpus.rate:12.0f}')
+    corpus = CorpusParser('nlparse:S', timeout=1.0)
+    for tokens, parses in corpus(split_sentences(read_tokens(path))):
+        pass
+    print(corpus.report())
+
+def bench_profile(sizes=(50, 200), top=5):
+    sentence = whole(S)
+    print(f'{"words":>6} {"plain s":>10} {"profiled s":>10} {"nodes":>8}')
+    for n in sizes:
+        tokens = adjective_chain(n)
+        profile = Profile()
+        plain = timeit(lambda: list(sentence(tokens)))
+        profiled = timeit(lambda: list(sentence(tokens, profile=profile)))
+        print(f'{n:6} {plain:10.4f} {profiled:10.4f} {sum(1 for node in profile.nodes()):8}')
+    # where the time goes, summed over all paths of each parser
+    stats = sorted(profile.stats().values(), key=lambda total: -total['seconds'])
+    for total in stats[:top]:
+        print(f'{total["label"]:>20} calls={total["calls"]} yields={total["yields"]} '
+              f'rejected={total["rejected"]} {total["seconds"]:.4f}s')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmarks for the parser combinators')
+    parser.parse_args(argv)
+    sys.setrecursionlimit(10000)
+    bench_packrat()
+    bench_chart()
+    bench_forest()
+    bench_constituent()
+    bench_lexicon()
+    bench_agreement()
+    bench_corpus()
+    bench_profile()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,235 @@
+"""Потоковый разбор корпусов в пуле процессов"""
+import os
+import csv
+import time
+import signal
+import argparse
+import importlib
+import itertools
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from nlparse import Parser, WholeParser
+
+SENTENCE_ENDS = frozenset({'.', '!', '?'})
+
+def read_tokens(path, column='WORD'):
+    """Генератор токенов из csv-файла корпуса (по одному на строку,
+    как в exercise-pandas/text.csv)"""
+    with open(path, encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            yield row[column]
+
+def split_sentences(tokens, ends=SENTENCE_ENDS):
+    """Генератор предложений: списков токенов между знаками конца
+    предложения (сами знаки в предложение не входят)"""
+    sentence = []
+    for token in tokens:
+        if token in ends:
+            if sentence:
+                yield sentence
+            sentence = []
+        else:
+            sentence.append(token)
+    if sentence:
+        yield sentence
+
+def batches(items, size):
+    """Генератор списков по size элементов"""
+    items = iter(items)
+    while True:
+        batch = list(itertools.islice(items, size))
+        if not batch:
+            return
+        yield batch
+
+def load_grammar(grammar, whole=True):
+    """Грамматика по описанию.
+
+    Грамматики, построенные через recursive(lambda ...), не передаются
+    между процессами, поэтому каждый процесс строит грамматику заново:
+    - строка 'модуль:имя' --- атрибут модуля (например 'nlparse:S'),
+      модуль импортируется в процессе, и грамматика строится при импорте;
+    - функция без аргументов, объявленная на уровне модуля, --- фабрика
+      грамматики;
+    - готовый парсер (только для разбора в текущем процессе).
+    whole=True оборачивает грамматику в WholeParser"""
+    if isinstance(grammar, str):
+        module, _, name = grammar.partition(':')
+        if not name:
+            raise ValueError(f"grammar should be given as 'module:name', got {grammar!r}")
+        grammar = getattr(importlib.import_module(module), name)
+    if not isinstance(grammar, Parser):
+        if not callable(grammar):
+            raise ValueError(f"cannot build a grammar from {grammar!r}")
+        grammar = grammar()
+    if whole and not isinstance(grammar, WholeParser):
+        grammar = WholeParser(grammar)
+    return grammar
+
+class ParseTimeout(Exception):
+    """Разбор предложения не уложился в отведенное время"""
+
+def _alarm(signum, frame):
+    raise ParseTimeout()
+
+class SentenceParser:
+    """Разбор отдельных предложений с ограничением времени.
+
+    Таймер (signal.setitimer) прерывает разбор в любом месте, но доступен
+    только в главном потоке и не во всех ОС; иначе время проверяется
+    между найденными разборами"""
+
+    def __init__(self, grammar, timeout=None, limit=None, whole=True, **options):
+        self.grammar = load_grammar(grammar, whole)
+        self.timeout = timeout
+        self.limit = limit
+        self.options = options
+
+    def alarm(self):
+        """Можно ли прерывать разбор таймером"""
+        return self.timeout is not None and hasattr(signal, 'setitimer') and \
+            threading.current_thread() is threading.main_thread()
+
+    def __call__(self, tokens):
+        """Список составляющих для предложения tokens (не больше limit)
+        или None, если время вышло"""
+        results = self.grammar(tokens, **self.options)
+        if self.timeout is None:
+            return [c for c, rest in itertools.islice(results, self.limit)]
+        if not self.alarm():
+            deadline = time.perf_counter() + self.timeout
+            parses = []
+            for c, rest in itertools.islice(results, self.limit):
+                if time.perf_counter() > deadline:
+                    return None
+                parses.append(c)
+            return parses
+        handler = signal.signal(signal.SIGALRM, _alarm)
+        try:
+            # таймер может сработать и во время собственной остановки
+            try:
+                signal.setitimer(signal.ITIMER_REAL, self.timeout)
+                return [c for c, rest in itertools.islice(results, self.limit)]
+            finally:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+        except ParseTimeout:
+            return None
+        finally:
+            signal.signal(signal.SIGALRM, handler)
+
+    def batch(self, sentences):
+        """Разборы пакета предложений"""
+        return [self(tokens) for tokens in sentences]
+
+_worker = None
+
+def _initialize(grammar, settings):
+    # каждый процесс пула строит свою грамматику
+    global _worker
+    _worker = SentenceParser(grammar, **settings)
+
+def _parse_batch(sentences):
+    return _worker.batch(sentences)
+
+class CorpusParser:
+    """Разбор потока предложений в пуле процессов.
+
+    Предложения отправляются процессам пакетами по batch штук;
+    одновременно обрабатывается не больше window пакетов, поэтому
+    память не растет с размером корпуса. Результаты возвращаются
+    генератором в порядке входа: пары (предложение, разборы), где
+    разборы --- список составляющих или None, если время вышло.
+    workers=0 выполняет разбор в текущем процессе.
+
+    Например:
+       parser = CorpusParser('nlparse:S', timeout=1.0)
+       for tokens, parses in parser(split_sentences(read_tokens('text.csv'))):
+           ...
+       print(parser.report())
+    """
+
+    def __init__(self, grammar, workers=None, batch=64, window=None, timeout=None, limit=None,
+                 whole=True, **options):
+        self.grammar = grammar
+        self.workers = workers
+        self.batch = batch
+        self.window = window
+        self.settings = dict(timeout=timeout, limit=limit, whole=whole, **options)
+        self.sentences = self.parsed = self.timeouts = 0
+        self.seconds = 0.0
+
+    def __call__(self, sentences):
+        """Генератор пар (предложение, разборы) в порядке входа"""
+        self.sentences = self.parsed = self.timeouts = 0
+        self.seconds = 0.0
+        start = time.perf_counter()
+        try:
+            if self.workers == 0:
+                worker = SentenceParser(self.grammar, **self.settings)
+                for batch in batches(sentences, self.batch):
+                    yield from self.collect(batch, worker.batch(batch), start)
+                return
+            with ProcessPoolExecutor(self.workers, initializer=_initialize,
+                                     initargs=(self.grammar, self.settings)) as pool:
+                window = self.window or 2 * (self.workers or os.cpu_count() or 1)
+                pending = deque()
+                try:
+                    for batch in batches(sentences, self.batch):
+                        pending.append((batch, pool.submit(_parse_batch, batch)))
+                        if len(pending) >= window:
+                            batch, future = pending.popleft()
+                            yield from self.collect(batch, future.result(), start)
+                    while pending:
+                        batch, future = pending.popleft()
+                        yield from self.collect(batch, future.result(), start)
+                finally:
+                    for batch, future in pending:
+                        future.cancel()
+        finally:
+            self.seconds = time.perf_counter() - start
+
+    def collect(self, batch, results, start):
+        """Пары (предложение, разборы) пакета с учетом в статистике"""
+        for tokens, parses in zip(batch, results):
+            self.sentences += 1
+            if parses is None:
+                self.timeouts += 1
+            elif parses:
+                self.parsed += 1
+            self.seconds = time.perf_counter() - start
+            yield (tokens, parses)
+
+    @property
+    def rate(self):
+        """Пропускная способность, предложений в секунду"""
+        return self.sentences / self.seconds if self.seconds else 0.0
+
+    def report(self):
+        """Строка-отчет о последнем разборе"""
+        return (f"{self.sentences} sentences ({self.parsed} parsed, {self.timeouts} timed out) "
+                f"in {self.seconds:.2f} s, {self.rate:.0f} sentences/s")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='parse a corpus with a grammar from nlparse')
+    parser.add_argument('path', help='csv file with one token per row')
+    parser.add_argument('--column', default='WORD')
+    parser.add_argument('--grammar', default='nlparse:S', help="grammar as 'module:name'")
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--batch', type=int, default=64)
+    parser.add_argument('--timeout', type=float, default=None, help='seconds per sentence')
+    parser.add_argument('--limit', type=int, default=None, help='parses kept per sentence')
+    parser.add_argument('--packrat', action='store_true')
+    parser.add_argument('--engine', default='combinators', choices=['combinators', 'chart'])
+    args = parser.parse_args(argv)
+    corpus = CorpusParser(args.grammar, workers=args.workers, batch=args.batch, timeout=args.timeout,
+                          limit=args.limit, packrat=args.packrat, engine=args.engine)
+    for tokens, parses in corpus(split_sentences(read_tokens(args.path, args.column))):
+        if parses:
+            for c in parses:
+                print(c)
+    print(corpus.report())
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
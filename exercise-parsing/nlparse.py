@@ -1,5 +1,145 @@
 """Функциональный синтаксический анализ"""
 import re
+import copy
+import time
+import weakref
+import itertools
+from collections import OrderedDict
+
+class Features:
+    """Интернированная структура признаков, например {'pos': 'N', 'number': 'Sg'}.
+
+    Каждой паре (признак, значение) назначается бит, структура хранится
+    одним целым числом bits. Признак может иметь несколько допустимых
+    значений (дизъюнкция), отсутствующий признак не ограничен.
+    Одинаковые структуры --- один и тот же объект"""
+
+    __slots__ = ('bits',)
+
+    BITS = {}
+    VALUES = []
+    MASKS = {}
+    INTERNED = {}
+
+    def __new__(cls, bits):
+        features = cls.INTERNED.get(bits)
+        if features is None:
+            features = super().__new__(cls)
+            features.bits = bits
+            cls.INTERNED[bits] = features
+        return features
+
+    @classmethod
+    def bit(cls, feature, value):
+        """Бит пары (признак, значение), при необходимости регистрирует ее"""
+        bit = cls.BITS.get((feature, value))
+        if bit is None:
+            bit = cls.BITS[(feature, value)] = 1 << len(cls.VALUES)
+            cls.VALUES.append((feature, value))
+            cls.MASKS[feature] = cls.MASKS.get(feature, 0) | bit
+        return bit
+
+    @classmethod
+    def make(cls, mapping):
+        """Структура по словарю; значением может быть строка
+        или коллекция допустимых значений"""
+        if isinstance(mapping, Features):
+            return mapping
+        bits = 0
+        for feature, values in mapping.items():
+            for value in ((values,) if isinstance(values, str) else values):
+                bits |= cls.bit(feature, value)
+        return cls(bits)
+
+    @staticmethod
+    def relabel(old, tag):
+        """Метка после применения @ tag: строка заменяет часть речи (pos)
+        у структуры признаков, остальные признаки сохраняются"""
+        if isinstance(old, Features) and isinstance(tag, str):
+            return old.replace('pos', tag)
+        return tag
+
+    def replace(self, feature, value):
+        """Структура с другим значением признака"""
+        return Features(self.bits & ~Features.MASKS.get(feature, 0) | Features.bit(feature, value))
+
+    def agree(self, other, feature):
+        """Согласованы ли структуры по признаку"""
+        mask = Features.MASKS.get(feature, 0)
+        x, y = self.bits & mask, other.bits & mask
+        return not x or not y or bool(x & y)
+
+    def unify(self, other):
+        """Унификация: пересечение значений по общим признакам,
+        None, если структуры несовместимы"""
+        bits = self.bits | other.bits
+        for mask in Features.MASKS.values():
+            x, y = self.bits & mask, other.bits & mask
+            if x and y:
+                if not x & y:
+                    return None
+                bits = bits & ~mask | x & y
+        return Features(bits)
+
+    def get(self, feature, default=None):
+        """Значение признака: строка, множество строк или default"""
+        values = [value for (name, value), bit in Features.BITS.items()
+                  if name == feature and self.bits & bit]
+        if not values:
+            return default
+        return values[0] if len(values) == 1 else frozenset(values)
+
+    def __getitem__(self, feature):
+        value = self.get(feature)
+        if value is None:
+            raise KeyError(feature)
+        return value
+
+    def items(self):
+        """Пары (признак, значение) в порядке регистрации признаков"""
+        return [(feature, self.get(feature)) for feature in Features.MASKS
+                if self.bits & Features.MASKS[feature]]
+
+    @classmethod
+    def lookup(cls, mapping):
+        """Биты структуры по словарю без регистрации новых пар;
+        None, если пара (признак, значение) неизвестна или значение
+        не строка и не коллекция строк"""
+        bits = 0
+        for feature, values in mapping.items():
+            if isinstance(values, str):
+                values = (values,)
+            elif not isinstance(values, (tuple, list, set, frozenset)):
+                return None
+            for value in values:
+                bit = cls.BITS.get((feature, value)) if isinstance(value, str) else None
+                if bit is None:
+                    return None
+                bits |= bit
+        return bits
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            return Features.lookup(other) == self.bits
+        return self is other
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __str__(self):
+        """Часть речи и остальные признаки в квадратных скобках: NP[number=Sg]"""
+        pos = self.get('pos')
+        rest = ','.join(f"{feature}={'|'.join(sorted(value)) if isinstance(value, frozenset) else value}"
+                        for feature, value in self.items() if feature != 'pos')
+        pos = '|'.join(sorted(pos)) if isinstance(pos, frozenset) else pos or ''
+        return f"{pos}[{rest}]" if rest else pos
+
+    def __repr__(self):
+        return f"Features({dict(self.items())!r})"
+
+    def __reduce__(self):
+        # номера битов зависят от порядка регистрации и в другом процессе могут отличаться
+        return (Features.make, (dict(self.items()),))
 
 class Constituent:
     """Класс-контейнер для составляющих, содержит три атрибута:
@@ -21,7 +161,7 @@ class Constituent:
     def __matmul__(self, tag):
         """Добавление метки к составляющей (поддержка оператора @)"""
 
-        return Constituent(tag=tag, children=self.children, words=self.words)
+        return Constituent(tag=Features.relabel(self.tag, tag), children=self.children, words=self.words)
 
     def __str__(self):
         """Строковое представление составляющей (поддержка str(c))"""
@@ -33,8 +173,301 @@ class Constituent:
 
         return f"{self.tag if self.tag is not None else ''}({arguments})"
 
+class SpanConstituent:
+    """Компактная составляющая: вместо собственного списка слов хранит
+    отрезок [start, end) общей цепочки токенов.
+
+    Конкатенация соседних составляющих и смена метки выполняются
+    за O(1), слова и строковое представление строятся по запросу"""
+
+    __slots__ = ('tag', 'children', 'tokens', 'start', 'end')
+
+    def __init__(self, tokens, start, end, tag=None, children=()):
+        self.tag = tag
+        self.children = children
+        self.tokens = tokens
+        self.start = start
+        self.end = end
+
+    @property
+    def words(self):
+        """Линейный список слов составляющей"""
+        return self.tokens[self.start:self.end]
+
+    def __add__(self, other):
+        """Конкатенация для составляющих (поддержка оператора +);
+        несмежные составляющие склеиваются в обычную Constituent"""
+        if isinstance(other, SpanConstituent) and other.tokens is self.tokens and \
+           other.start == self.end:
+            return SpanConstituent(self.tokens, self.start, other.end, children=(self, other))
+        return Constituent(children=(self, other), words=self.words + other.words)
+
+    def __matmul__(self, tag):
+        """Добавление метки к составляющей (поддержка оператора @)"""
+        return SpanConstituent(self.tokens, self.start, self.end, Features.relabel(self.tag, tag), self.children)
+
+    def __str__(self):
+        """Строковое представление составляющей (поддержка str(c)),
+        совпадает с представлением Constituent"""
+        parts = []
+        pending = [self]
+        while pending:
+            item = pending.pop()
+            if isinstance(item, str):
+                parts.append(item)
+            elif not isinstance(item, SpanConstituent):
+                parts.append(str(item))
+            elif item.children:
+                parts.append(f"{item.tag if item.tag is not None else ''}(")
+                pending.append(')')
+                for i in range(len(item.children) - 1, -1, -1):
+                    pending.append(item.children[i])
+                    if i:
+                        pending.append(',')
+            else:
+                parts.append(f"{item.tag if item.tag is not None else ''}({','.join(item.words)})")
+        return ''.join(parts)
+
+class PackratCache:
+    """Ограниченный кэш packrat-разбора: (парсер, позиция) -> список результатов.
+    При переполнении вытесняются давно не использовавшиеся элементы"""
+
+    def __init__(self, maxsize=65536):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        """Возвращает сохраненный список результатов или None"""
+        results = self.entries.get(key)
+        if results is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return results
+
+    def put(self, key, results):
+        """Сохраняет список результатов, вытесняя самый старый элемент"""
+        self.entries[key] = results
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Очищает кэш и счетчики"""
+        self.entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        """Статистика использования кэша"""
+        return {'size': len(self.entries), 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+class ParseState:
+    """Состояние разбора: одна общая цепочка токенов, на которую
+    парсеры ссылаются целочисленными позициями вместо срезов"""
+
+    def __init__(self, tokens):
+        self.tokens = tuple(tokens)
+
+    def call(self, parser, pos):
+        """Вызывает парсер с позиции pos, возвращает итератор
+        пар (составляющая, позиция конца)"""
+        return parser.parse(self, pos)
+
+class PackratState(ParseState):
+    """Состояние packrat-разбора: каждый парсер выполняется
+    не более одного раза на каждой позиции"""
+
+    def __init__(self, tokens, cache):
+        super().__init__(tokens)
+        self.cache = cache
+
+    def call(self, parser, pos):
+        """Результаты берутся из кэша, при промахе полностью
+        вычисляются и сохраняются"""
+        key = (parser, pos)
+        results = self.cache.get(key)
+        if results is None:
+            results = list(parser.parse(self, pos))
+            self.cache.put(key, results)
+        return results
+
+class ProfileNode:
+    """Узел дерева вызовов профиля: один парсер на одном пути вызовов.
+    - calls: число вызовов
+    - yields: число выданных результатов
+    - hits: число вызовов, ответ на которые взят из packrat-кэша
+    - seconds: время внутри вызовов, включая вложенные"""
+
+    __slots__ = ('parser', 'calls', 'yields', 'hits', 'seconds', 'children')
+
+    def __init__(self, parser):
+        self.parser = parser
+        self.calls = self.yields = self.hits = 0
+        self.seconds = 0.0
+        self.children = {}
+
+    def child(self, parser):
+        """Узел для вызова parser из этого узла"""
+        node = self.children.get(parser)
+        if node is None:
+            node = self.children[parser] = ProfileNode(parser)
+        return node
+
+    @property
+    def label(self):
+        """Имя узла: класс парсера, слово или метка"""
+        parser = self.parser
+        if parser is None:
+            return 'parse'
+        name = type(parser).__name__
+        if isinstance(parser, WordParser):
+            return f"{name}({parser.w})"
+        if isinstance(parser, TagParser):
+            return f"{name}@{parser.tag}"
+        return name
+
+    @property
+    def rejected(self):
+        """Число результатов дочерних парсеров, отброшенных фильтром
+        (FilterParser, WholeParser); для остальных узлов 0"""
+        if not isinstance(self.parser, (FilterParser, WholeParser)):
+            return 0
+        return sum(node.yields for node in self.children.values()) - self.yields
+
+    @property
+    def self_seconds(self):
+        """Время внутри вызовов без учета вложенных"""
+        return self.seconds - sum(node.seconds for node in self.children.values())
+
+class Profile:
+    """Профиль разбора: дерево вызовов парсеров со счетчиками.
+
+    Включается явно: parser(tokens, profile=Profile()); один профиль
+    накапливает статистику нескольких разборов. Без профиля разбор
+    выполняется обычным ParseState и ничего не стоит.
+
+    Например:
+       profile = Profile()
+       list(whole(S)(tokens, profile=profile))
+       print(profile)                  # дерево вызовов
+       profile.folded()                # строки для flamegraph.pl / speedscope"""
+
+    def __init__(self):
+        self.root = ProfileNode(None)
+
+    def nodes(self):
+        """Генератор пар (путь, узел) обхода в глубину;
+        путь --- кортеж узлов от корня"""
+        pending = [((self.root,), self.root)]
+        while pending:
+            path, node = pending.pop()
+            yield path, node
+            for child in reversed(list(node.children.values())):
+                pending.append((path + (child,), child))
+
+    def stats(self):
+        """Сводка по парсерам (без учета путей): парсер -> словарь счетчиков"""
+        totals = {}
+        for path, node in self.nodes():
+            if node.parser is None:
+                continue
+            total = totals.setdefault(node.parser, {'label': node.label, 'calls': 0, 'yields': 0,
+                                                    'rejected': 0, 'hits': 0, 'seconds': 0.0})
+            total['calls'] += node.calls
+            total['yields'] += node.yields
+            total['rejected'] += node.rejected
+            total['hits'] += node.hits
+            total['seconds'] += node.self_seconds
+        return totals
+
+    def folded(self, value='seconds'):
+        """Профиль в формате свернутых стеков (folded stacks), который
+        понимают flamegraph.pl и speedscope: строка "корень;...;узел число"
+        на каждый путь. value='seconds' --- собственное время в микросекундах,
+        'calls' или 'yields' --- соответствующие счетчики"""
+        lines = []
+        for path, node in self.nodes():
+            if value == 'seconds':
+                count = round(node.self_seconds * 1e6)
+            elif value in ('calls', 'yields'):
+                count = getattr(node, value)
+            else:
+                raise ValueError(f"unknown profile value {value!r}")
+            if count > 0:
+                stack = ';'.join(item.label.replace(';', ',').replace(' ', '_') for item in path)
+                lines.append(f"{stack} {count}")
+        return lines
+
+    def __str__(self):
+        """Дерево вызовов с отступами"""
+        lines = []
+        for path, node in self.nodes():
+            if node.parser is None:
+                continue
+            counters = f"calls={node.calls} yields={node.yields}"
+            if node.rejected:
+                counters += f" rejected={node.rejected}"
+            if node.hits:
+                counters += f" hits={node.hits}"
+            lines.append(f"{'  ' * (len(path) - 2)}{node.label} {counters} {node.seconds * 1e3:.3f}ms")
+        return '\n'.join(lines)
+
+class ProfileState(PackratState):
+    """Состояние разбора с профилированием: каждый вызов парсера
+    учитывается в узле дерева вызовов Profile. cache=None --- без
+    packrat-кэша"""
+
+    def __init__(self, tokens, profile, cache=None):
+        super().__init__(tokens, cache)
+        self.current = profile.root
+
+    def call(self, parser, pos):
+        """Обертка над вызовом: время и текущий узел учитываются только
+        пока выполняется сам вызов, поэтому чередование генераторов
+        не смешивает статистику"""
+        parent = self.current
+        node = parent.child(parser)
+        node.calls += 1
+        self.current = node
+        start = time.perf_counter()
+        try:
+            if self.cache is None:
+                results = parser.parse(self, pos)
+            else:
+                hits = self.cache.hits
+                results = iter(super().call(parser, pos))
+                node.hits += self.cache.hits - hits
+        finally:
+            node.seconds += time.perf_counter() - start
+            self.current = parent
+        return self.trace(node, results)
+
+    def trace(self, node, results):
+        parent = self.current
+        while True:
+            self.current = node
+            start = time.perf_counter()
+            try:
+                item = next(results)
+            except StopIteration:
+                return
+            finally:
+                node.seconds += time.perf_counter() - start
+                self.current = parent
+            node.yields += 1
+            yield item
+
 class Parser:
-    """Базовый класс парсеров, реализует только поддержку операторов"""
+    """Базовый класс парсеров, реализует поддержку операторов
+    и запуск разбора на цепочке токенов"""
 
     def __add__(self, other):
         """Конкатенация парсеров (поддержка оператора +)"""
@@ -48,10 +481,49 @@ class Parser:
         """Добавление категориальной метки (поддержка оператора @)"""
         return TagParser(tag, self)
 
-    def __call__(self, tokens):
+    def __call__(self, tokens, packrat=False, engine='combinators', profile=None):
+        """Генератор пар (составляющая, хвост цепочки).
+
+        packrat=True включает packrat-кэш, можно также передать
+        собственный экземпляр PackratCache (он очищается перед разбором).
+        engine='chart' выполняет разбор табличным алгоритмом Эрли,
+        который допускает леворекурсивные грамматики.
+        profile --- экземпляр Profile, в который записывается статистика
+        вызовов парсеров (только для комбинаторов)"""
+        if profile is not None and engine != 'combinators':
+            raise ValueError("profiling is only available for engine='combinators'")
+        if engine == 'chart':
+            for c, end in Grammar.compile(self).parse(tokens):
+                yield (c, tokens[end:])
+            return
+        if engine != 'combinators':
+            raise ValueError(f"unknown parsing engine {engine!r}")
+        if isinstance(packrat, PackratCache) or packrat:
+            cache = packrat if isinstance(packrat, PackratCache) else PackratCache()
+            cache.clear()
+            state = PackratState(tokens, cache) if profile is None else ProfileState(tokens, profile, cache)
+        elif profile is not None:
+            state = ProfileState(tokens, profile)
+        else:
+            state = ParseState(tokens)
+        for c, end in state.call(self, 0):
+            yield (c, tokens[end:])
+
+    def forest(self, tokens):
+        """Разбор в режиме леса: возвращает Forest, в котором каждая пара
+        (категория, отрезок) хранится один раз, а неоднозначности упакованы"""
+        return Grammar.compile(self).forest(tokens)
+
+    def parse(self, state, pos):
         """Все подклассы должны переопределить этот метод так, чтобы
-        он возвращал генератор (yield), выдающий пары (составляющая, хвост цепочки)"""
-        pass
+        он возвращал генератор (yield), выдающий пары (составляющая, позиция конца).
+
+        Для подклассов, переопределивших только __call__, хвосты
+        переводятся в позиции"""
+        if type(self).__call__ is Parser.__call__:
+            raise NotImplementedError(f"{type(self).__name__} must define parse()")
+        for c, tail in self(list(state.tokens[pos:])):
+            yield (c, len(state.tokens) - len(tail))
 
 class WordParser(Parser):
     """Парсер, который принимает ровно одно заданное слово"""
@@ -59,11 +531,11 @@ class WordParser(Parser):
     def __init__(self, w):
         self.w = w
 
-    def __call__(self, tokens):
+    def parse(self, state, pos):
         """Генератор порождает не более одной пары, где в составляющей тег пустой,
         детей нет, а список слов состоит из одного слова"""
-        if len(tokens) > 0 and tokens[0] == self.w:
-            yield (Constituent(words=(self.w,)), tokens[1:])
+        if pos < len(state.tokens) and state.tokens[pos] == self.w:
+            yield (SpanConstituent(state.tokens, pos, pos + 1), pos + 1)
 
 
 class SeqParser(Parser):
@@ -73,13 +545,13 @@ class SeqParser(Parser):
         self.p1 = p1
         self.p2 = p2
 
-    def __call__(self, tokens):
-        """Сначала вызывается парсер p1, потом для каждого возможного хвоста
-        вызывается парсер p2. Результирующая составляющая есть конкатенация
+    def parse(self, state, pos):
+        """Сначала вызывается парсер p1, потом для каждой возможной позиции
+        конца вызывается парсер p2. Результирующая составляющая есть конкатенация
         составляющих с пустым тегом"""
-        for c1, tokens1 in self.p1(tokens):
-            for c2, tokens2 in self.p2(tokens1):
-                yield (c1 + c2, tokens2)
+        for c1, pos1 in state.call(self.p1, pos):
+            for c2, pos2 in state.call(self.p2, pos1):
+                yield (c1 + c2, pos2)
 
 class AltParser(Parser):
     """Парсер --- альтерация парсеров"""
@@ -88,22 +560,23 @@ class AltParser(Parser):
         self.p1 = p1
         self.p2 = p2
 
-    def __call__(self, tokens):
+    def parse(self, state, pos):
         """Возвращаются последовательно варианты разбора от обоих парсеров"""
-        yield from self.p1(tokens)
-        yield from self.p2(tokens)
+        yield from state.call(self.p1, pos)
+        yield from state.call(self.p2, pos)
 
 class TagParser(Parser):
-    """Парсер, снабжающий меткой результат нижележащего парсера"""
+    """Парсер, снабжающий меткой результат нижележащего парсера.
+    Метка-словарь превращается в интернированную структуру Features"""
 
     def __init__(self, tag, p):
         self.p = p
-        self.tag = tag
+        self.tag = Features.make(tag) if isinstance(tag, dict) else tag
 
-    def __call__(self, tokens):
+    def parse(self, state, pos):
         """Метки составляющих заменяются на tag"""
-        for c, tokens1 in self.p(tokens):
-            yield (c @ self.tag, tokens1)
+        for c, pos1 in state.call(self.p, pos):
+            yield (c @ self.tag, pos1)
 
 
 class FilterParser(Parser):
@@ -117,12 +590,19 @@ class FilterParser(Parser):
         чтобы определять валидность составляющей c"""
         return True
 
-    def __call__(self, tokens):
+    def decide(self, node, children):
+        """Значение predicate, общее для всех составляющих, которые выводятся
+        из узла леса node через альтернативу children (кортеж дочерних узлов),
+        или None, если оно зависит от дерева. Подклассы, которые переопределяют
+        этот метод, позволяют лесу считать деревья без их перечисления"""
+        return None
+
+    def parse(self, state, pos):
         """Возвращаются только те результаты нижележащего
         парсера, составляющая которых удовлетворяет методу predicate"""
-        for c, tokens1 in self.p(tokens):
+        for c, pos1 in state.call(self.p, pos):
             if self.predicate(c):
-                yield (c, tokens1)
+                yield (c, pos1)
 
 class RecursiveParser(Parser):
     """Парсер --- рекурсивное замыкание.
@@ -132,15 +612,17 @@ class RecursiveParser(Parser):
     вызывает N или Adj, а затем рекурсивно самого себя.
 
     Внимание: рекурсивный аргумент не может быть самым
-    левым аргументом + и т.п.
+    левым аргументом + и т.п., если разбор выполняется
+    комбинаторами; табличный разбор (engine='chart')
+    допускает левую рекурсию.
     """
 
     def __init__(self, fp):
         self.p = fp(self)
 
-    def __call__(self, tokens):
+    def parse(self, state, pos):
         """Вызывает рекурсивно замкнутый нижележащий парсер"""
-        yield from self.p(tokens)
+        yield from state.call(self.p, pos)
 
 
 class WholeParser(Parser):
@@ -149,12 +631,636 @@ class WholeParser(Parser):
     def __init__(self, p):
         self.p = p
 
-    def __call__(self, tokens):
+    def parse(self, state, pos):
         """Возвращает только те результаты нижележащего парсера,
         у который хвост --- пустая цепочка"""
-        for c, tokens1 in self.p(tokens):
-            if not tokens1:
-                yield (c, tokens1)
+        for c, pos1 in state.call(self.p, pos):
+            if pos1 == len(state.tokens):
+                yield (c, pos1)
+
+class AgreementParser(SeqParser):
+    """Парсер согласования: конкатенация, которая возвращает только
+    составляющие, согласованные по признаку feature.
+
+    Проверка согласования --- одна операция над битами; меткой результата
+    становится структура с общим значением признака, например [number=Sg]"""
+
+    def __init__(self, feature, p1, p2):
+        super().__init__(p1, p2)
+        self.feature = feature
+
+    def parse(self, state, pos):
+        """Как SeqParser, но пары с несовместимыми значениями признака
+        отбрасываются"""
+        mask = Features.MASKS.get(self.feature, 0)
+        interned = Features.INTERNED
+        for c1, pos1 in state.call(self.p1, pos):
+            x = getattr(c1.tag, 'bits', 0) & mask
+            for c2, pos2 in state.call(self.p2, pos1):
+                y = getattr(c2.tag, 'bits', 0) & mask
+                common = x & y
+                if common or not x or not y:
+                    bits = common or x | y
+                    yield ((c1 + c2) @ (interned.get(bits) or Features(bits)), pos2)
+
+class LexiconParser(Parser):
+    """Словарный парсер: заменяет цепочку альтернатив из WordParser
+    одним поиском в хэш-таблице. Слово, встречавшееся в цепочке
+    несколько раз, дает столько же результатов"""
+
+    def __init__(self, words):
+        self.counts = {}
+        for w in words:
+            self.counts[w] = self.counts.get(w, 0) + 1
+
+    def parse(self, state, pos):
+        """Порождает по одной однословной составляющей на каждое
+        вхождение текущего слова в словарь"""
+        if pos < len(state.tokens):
+            for i in range(self.counts.get(state.tokens[pos], 0)):
+                yield (SpanConstituent(state.tokens, pos, pos + 1), pos + 1)
+
+class FirstAltParser(AltParser):
+    """Альтерация, пропускающая ветви, которые не могут начаться с текущего
+    слова. first1, first2 --- множества FIRST ветвей или None, если ветвь
+    нужно вызывать всегда (она может быть пустой или ее FIRST неизвестно)"""
+
+    def __init__(self, p1, p2, first1=None, first2=None):
+        super().__init__(p1, p2)
+        self.first1 = first1
+        self.first2 = first2
+
+    def parse(self, state, pos):
+        """Как AltParser, но ветвь вызывается только если текущее слово
+        входит в ее FIRST"""
+        token = state.tokens[pos] if pos < len(state.tokens) else None
+        if self.first1 is None or token in self.first1:
+            yield from state.call(self.p1, pos)
+        if self.first2 is None or token in self.first2:
+            yield from state.call(self.p2, pos)
+
+class FirstSeqParser(SeqParser):
+    """Конкатенация, которая вызывает p2 только на тех позициях,
+    с которых он может начаться (first2 --- FIRST парсера p2 или None)"""
+
+    def __init__(self, p1, p2, first2=None):
+        super().__init__(p1, p2)
+        self.first2 = first2
+
+    def parse(self, state, pos):
+        """Как SeqParser, но хвосты, не начинающиеся со слова из first2,
+        пропускаются"""
+        tokens = state.tokens
+        for c1, pos1 in state.call(self.p1, pos):
+            if self.first2 is not None and (pos1 >= len(tokens) or tokens[pos1] not in self.first2):
+                continue
+            for c2, pos2 in state.call(self.p2, pos1):
+                yield (c1 + c2, pos2)
+
+class Grammar:
+    """Грамматика, построенная по графу комбинаторов: каждому узлу-парсеру
+    соответствует нетерминал, а правила содержат не более двух символов.
+
+    Узлы, которые не являются стандартными комбинаторами, считаются
+    непрозрачными: на каждой позиции они вызываются обычным разбором,
+    а их результаты попадают в таблицу как готовые составляющие"""
+
+    WORD, SEQ, ALT, TAG, FILTER, RECURSIVE, WHOLE, OPAQUE = range(8)
+
+    KINDS = {WordParser.parse: WORD, SeqParser.parse: SEQ, FirstSeqParser.parse: SEQ,
+             AltParser.parse: ALT, FirstAltParser.parse: ALT, TagParser.parse: TAG,
+             FilterParser.parse: FILTER, RecursiveParser.parse: RECURSIVE,
+             WholeParser.parse: WHOLE}
+
+    COMPILED = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def kind(cls, node):
+        """Вид узла-парсера, определяется по его методу parse"""
+        return cls.KINDS.get(type(node).parse, cls.OPAQUE)
+
+    @classmethod
+    def children(cls, node, kind):
+        """Дочерние парсеры узла данного вида"""
+        if kind == cls.SEQ or kind == cls.ALT:
+            return (node.p1, node.p2)
+        if kind == cls.WORD or kind == cls.OPAQUE:
+            return ()
+        return (node.p,)
+
+    def __init__(self, start):
+        self.nodes = []
+        self.kinds = []
+        self.rules = []
+        index = {}
+        pending = [start]
+        while pending:
+            node = pending.pop()
+            if node in index:
+                continue
+            index[node] = len(self.nodes)
+            self.nodes.append(node)
+            kind = self.kind(node)
+            self.kinds.append(kind)
+            pending.extend(reversed(self.children(node, kind)))
+
+        for node, kind in zip(self.nodes, self.kinds):
+            if kind == self.WORD:
+                self.rules.append([(node.w,)])
+            elif kind == self.SEQ:
+                self.rules.append([(index[node.p1], index[node.p2])])
+            elif kind == self.ALT:
+                self.rules.append([(index[node.p1],), (index[node.p2],)])
+            elif kind == self.OPAQUE:
+                self.rules.append([])
+            else:
+                self.rules.append([(index[node.p],)])
+
+    @classmethod
+    def compile(cls, parser):
+        """Грамматика для парсера, строится один раз и кэшируется"""
+        grammar = cls.COMPILED.get(parser)
+        if grammar is None:
+            grammar = cls.COMPILED[parser] = cls(parser)
+        return grammar
+
+    def parse(self, tokens):
+        """Генератор пар (составляющая, позиция конца) для начального символа"""
+        return self.forest(tokens).trees()
+
+    def forest(self, tokens):
+        """Упакованный лес разбора цепочки"""
+        return Forest(Chart(self, tokens))
+
+class Chart:
+    """Таблица алгоритма Эрли. Ситуация --- кортеж (символ, номер правила,
+    позиция точки, начало), для непрозрачных символов номер правила равен -1.
+    ends[(символ, начало)] --- множество позиций, где символ завершен"""
+
+    def __init__(self, grammar, tokens):
+        self.grammar = grammar
+        self.tokens = tuple(tokens)
+        self.ends = {}
+        self.opaque = {}
+        self.recognize()
+
+    def recognize(self):
+        """Заполняет таблицу, время работы --- O(n^3) от длины цепочки"""
+        grammar, tokens = self.grammar, self.tokens
+        n = len(tokens)
+        sets = [[] for i in range(n + 1)]
+        seen = [set() for i in range(n + 1)]
+        predicted = [set() for i in range(n + 1)]
+        waiting = [{} for i in range(n + 1)]
+        ends = self.ends
+
+        def add(i, item):
+            if item not in seen[i]:
+                seen[i].add(item)
+                sets[i].append(item)
+
+        def predict(symbol, i):
+            if symbol in predicted[i]:
+                return
+            predicted[i].add(symbol)
+            if grammar.kinds[symbol] == Grammar.OPAQUE:
+                results = list(grammar.nodes[symbol].parse(ParseState(tokens), i))
+                self.opaque[(symbol, i)] = results
+                for c, end in results:
+                    add(end, (symbol, -1, 1, i))
+                return
+            for rule in range(len(grammar.rules[symbol])):
+                add(i, (symbol, rule, 0, i))
+
+        predict(0, 0)
+        for i in range(n + 1):
+            items = sets[i]
+            k = 0
+            while k < len(items):
+                item = items[k]
+                k += 1
+                symbol, rule, dot, origin = item
+                rhs = grammar.rules[symbol][rule] if rule >= 0 else ()
+                if rule < 0 or dot == len(rhs):
+                    if grammar.kinds[symbol] == Grammar.WHOLE and i != n:
+                        continue
+                    done = ends.setdefault((symbol, origin), set())
+                    if i in done:
+                        continue
+                    done.add(i)
+                    for parent, prule, pdot, porigin in waiting[origin].get(symbol, ()):
+                        add(i, (parent, prule, pdot + 1, porigin))
+                    continue
+                next_symbol = rhs[dot]
+                if isinstance(next_symbol, str):
+                    if i < n and tokens[i] == next_symbol:
+                        add(i + 1, (symbol, rule, dot + 1, origin))
+                    continue
+                waiting[i].setdefault(next_symbol, []).append(item)
+                if i in ends.get((next_symbol, i), ()):
+                    add(i, (symbol, rule, dot + 1, origin))
+                predict(next_symbol, i)
+
+class ForestNode:
+    """Узел упакованного леса разбора: символ грамматики на отрезке [start, end).
+
+    packed --- альтернативы вывода (кортежи дочерних узлов), count --- число
+    деревьев, выводимых из узла; деревья нумеруются в порядке перечисления.
+
+    bound --- число деревьев без учета фильтров (верхняя оценка), считается
+    при построении. Если ниже узла есть FilterParser, точное число деревьев
+    вычисляется при первом обращении к count: фильтр, метод decide которого
+    решает каждую альтернативу вывода своего ребенка, считается по
+    альтернативам, иначе --- перечислением всех деревьев под фильтром"""
+
+    __slots__ = ('kind', 'parser', 'tokens', 'start', 'end', 'packed', 'leaves', 'accepted',
+                 'decisions', 'bound', '_count', '_tags')
+
+    def __init__(self, kind, parser, tokens, start, end):
+        self.kind = kind
+        self.parser = parser
+        self.tokens = tokens
+        self.start = start
+        self.end = end
+        self.packed = []
+        self.leaves = ()
+        self.accepted = ()
+        self.decisions = None
+        self.bound = 0
+        self._count = 0
+        self._tags = None
+
+    @property
+    def words(self):
+        """Слова отрезка узла"""
+        return self.tokens[self.start:self.end]
+
+    @property
+    def count(self):
+        """Точное число деревьев; отложенные счетчики узлов с фильтрами
+        вычисляются без рекурсии, от детей к родителям"""
+        if self._count is None:
+            pending = [self]
+            while pending:
+                node = pending[-1]
+                if node._count is not None:
+                    pending.pop()
+                    continue
+                children = [child for child in node.needed() if child._count is None]
+                if children:
+                    pending.extend(children)
+                    continue
+                pending.pop()
+                node._count = node.exact()
+        return self._count
+
+    def decide(self):
+        """Для узла фильтра: значения предиката для каждой альтернативы
+        вывода ребенка (см. FilterParser.decide) или None, если хотя бы
+        одну альтернативу можно проверить только перечислением"""
+        if self.decisions is None:
+            child = self.packed[0][0]
+            decisions = [self.parser.decide(child, children) for children in child.packed]
+            self.decisions = False if not decisions or None in decisions else decisions
+        return self.decisions or None
+
+    def needed(self):
+        """Узлы, счетчики которых нужны для точного счетчика этого узла"""
+        if self.kind != Grammar.FILTER:
+            return [child for children in self.packed for child in children]
+        # фильтр считается по альтернативам ребенка или перечисляет деревья
+        if not self.packed or self.decide() is None:
+            return []
+        return [child for children in self.packed[0][0].packed for child in children]
+
+    def exact(self):
+        """Число деревьев при известных счетчиках детей. Для фильтра accepted ---
+        отрезки (начало, длина) принятых номеров деревьев ребенка"""
+        if self.kind != Grammar.FILTER:
+            return sum(self.size(children) for children in self.packed)
+        if not self.packed:
+            return 0
+        child = self.packed[0][0]
+        decisions = self.decide()
+        accepted = []
+        if decisions is None:
+            for i, c in enumerate(child.trees()):
+                if not self.parser.predicate(c):
+                    continue
+                if accepted and sum(accepted[-1]) == i:
+                    accepted[-1] = (accepted[-1][0], accepted[-1][1] + 1)
+                else:
+                    accepted.append((i, 1))
+        else:
+            offset = 0
+            for children, decision in zip(child.packed, decisions):
+                size = self.size(children)
+                if decision and size:
+                    accepted.append((offset, size))
+                offset += size
+        self.accepted = accepted
+        return sum(size for offset, size in accepted)
+
+    @staticmethod
+    def size(children):
+        """Число деревьев альтернативы вывода"""
+        size = 1
+        for child in children:
+            size *= child.count
+        return size
+
+    def tags(self):
+        """Множество возможных меток деревьев узла (для фильтра --- с запасом,
+        без проверки предиката); вычисляется один раз без рекурсии"""
+        if self._tags is None:
+            pending = [self]
+            while pending:
+                node = pending[-1]
+                if node._tags is not None:
+                    pending.pop()
+                    continue
+                # конкатенация всегда дает составляющую без метки
+                children = [] if node.kind == Grammar.SEQ else \
+                    [child for group in node.packed for child in group if child._tags is None]
+                if children:
+                    pending.extend(children)
+                    continue
+                pending.pop()
+                if node.kind == Grammar.WORD or node.kind == Grammar.SEQ:
+                    node._tags = {None}
+                elif node.kind == Grammar.OPAQUE:
+                    node._tags = {c.tag for c in node.leaves}
+                elif node.kind == Grammar.TAG:
+                    node._tags = {Features.relabel(tag, node.parser.tag) for (child,) in node.packed
+                                  for tag in child._tags}
+                else:
+                    node._tags = {tag for (child,) in node.packed for tag in child._tags}
+        return self._tags
+
+    def trees(self):
+        """Ленивое перечисление составляющих, выводимых из узла"""
+        kind = self.kind
+        if kind == Grammar.WORD or kind == Grammar.OPAQUE:
+            yield from self.leaves
+        elif kind == Grammar.SEQ:
+            for left, right in self.packed:
+                for c1 in left.trees():
+                    for c2 in right.trees():
+                        yield c1 + c2
+        elif kind == Grammar.TAG:
+            for c in self.packed[0][0].trees():
+                yield c @ self.parser.tag
+        elif kind == Grammar.FILTER:
+            for c in self.packed[0][0].trees():
+                if self.parser.predicate(c):
+                    yield c
+        else:
+            for (child,) in self.packed:
+                yield from child.trees()
+
+    def tree(self, index):
+        """Составляющая с номером index, строится без перечисления предыдущих.
+        Как и при разборе комбинаторами, это SpanConstituent"""
+        if not 0 <= index < self.count:
+            raise IndexError("tree index out of range")
+        kind = self.kind
+        if kind == Grammar.WORD or kind == Grammar.OPAQUE:
+            return self.leaves[index]
+        if kind == Grammar.TAG:
+            return self.packed[0][0].tree(index) @ self.parser.tag
+        if kind == Grammar.FILTER:
+            for offset, size in self.accepted:
+                if index < size:
+                    return self.packed[0][0].tree(offset + index)
+                index -= size
+        for children in self.packed:
+            size = self.size(children)
+            if index < size:
+                break
+            index -= size
+        if kind == Grammar.SEQ:
+            left, right = children
+            return left.tree(index // right.count) + right.tree(index % right.count)
+        return children[0].tree(index)
+
+class Forest:
+    """Упакованный лес разбора: каждый узел (символ, отрезок) хранится
+    один раз, альтернативные выводы упакованы в нем.
+
+    roots --- узлы начального символа для всех возможных концов разбора"""
+
+    def __init__(self, chart):
+        self.chart = chart
+        self.nodes = {}
+        self.roots = [self.node(0, 0, end) for end in sorted(chart.ends.get((0, 0), ()))]
+        self.roots = [root for root in self.roots if root.bound]
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def count(self):
+        """Число полных деревьев разбора; деревья под FilterParser, который
+        не переопределяет decide, перечисляются"""
+        return sum(root.count for root in self.roots)
+
+    def trees(self):
+        """Ленивое перечисление пар (составляющая, позиция конца)"""
+        for root in self.roots:
+            for c in root.trees():
+                yield (c, root.end)
+
+    def first(self, k):
+        """Первые k пар (составляющая, позиция конца)"""
+        return list(itertools.islice(self.trees(), k))
+
+    def tree(self, index):
+        """Пара (составляющая, позиция конца) с номером index"""
+        for root in self.roots:
+            if index < root.count:
+                return (root.tree(index), root.end)
+            index -= root.count
+        raise IndexError("tree index out of range")
+
+    def node(self, symbol, start, end):
+        """Узел леса для символа на отрезке, строится один раз без рекурсии.
+        Циклические унарные выводы отбрасываются"""
+        pending = [(symbol, start, end)]
+        while pending:
+            key = pending[-1]
+            node = self.nodes.get(key)
+            if node is None:
+                node = self.nodes[key] = self.create(*key)
+                pending.extend(child for children in node.packed for child in children
+                               if child not in self.nodes)
+            else:
+                pending.pop()
+                if node.bound is None:
+                    self.finish(node)
+        return self.nodes[(symbol, start, end)]
+
+    def create(self, symbol, start, end):
+        """Новый узел; для внутренних узлов packed пока содержит ключи детей"""
+        chart = self.chart
+        grammar = chart.grammar
+        kind = grammar.kinds[symbol]
+        node = ForestNode(kind, grammar.nodes[symbol], chart.tokens, start, end)
+        if kind == Grammar.WORD:
+            node.leaves = (SpanConstituent(chart.tokens, start, end),)
+            node.bound = node._count = 1
+        elif kind == Grammar.OPAQUE:
+            node.leaves = tuple(c for c, pos in chart.opaque.get((symbol, start), ()) if pos == end)
+            node.bound = node._count = len(node.leaves)
+        elif kind == Grammar.SEQ:
+            node.bound = None
+            left, right = grammar.rules[symbol][0]
+            for middle in sorted(chart.ends.get((left, start), ())):
+                if middle <= end and end in chart.ends.get((right, middle), ()):
+                    node.packed.append(((left, start, middle), (right, middle, end)))
+        else:
+            node.bound = None
+            for (child,) in grammar.rules[symbol]:
+                if end in chart.ends.get((child, start), ()):
+                    node.packed.append(((child, start, end),))
+        return node
+
+    def finish(self, node):
+        """Подставляет детей и считает деревья без учета фильтров; дети,
+        которые еще строятся, образуют цикл и пропускаются. Предикаты
+        фильтров здесь не вызываются: точный счетчик узла с фильтром
+        ниже откладывается до обращения к count"""
+        packed = []
+        bound = 0
+        filtered = node.kind == Grammar.FILTER
+        for keys in node.packed:
+            children = tuple(self.nodes[key] for key in keys)
+            size = 1
+            for child in children:
+                size *= child.bound or 0
+            if size:
+                packed.append(children)
+                bound += size
+                filtered = filtered or any(child._count is None for child in children)
+        node.packed = packed
+        node.bound = bound
+        node._count = None if filtered and bound else bound
+
+class Optimizer:
+    """Оптимизация графа комбинаторов. Строит копию графа, в которой
+    - цепочки альтернатив из WordParser свернуты в LexiconParser;
+    - AltParser и SeqParser заменены на FirstAltParser и FirstSeqParser,
+      которые по множествам FIRST пропускают заведомо неуспешные ветви.
+    Результаты разбора совпадают с исходным графом, включая порядок"""
+
+    def optimize(self, start):
+        """Возвращает оптимизированную копию графа с корнем start"""
+        clones = {}
+        order = []
+        pending = [start]
+        while pending:
+            node = pending.pop()
+            if node in clones:
+                continue
+            kind = Grammar.kind(node)
+            if kind == Grammar.ALT:
+                clone = self.alternatives(node)
+            elif kind == Grammar.SEQ:
+                clone = FirstSeqParser(node.p1, node.p2)
+            elif kind == Grammar.WORD or kind == Grammar.OPAQUE:
+                clone = node
+            else:
+                clone = copy.copy(node)
+            clones[node] = clone
+            order.append(clone)
+            for child in self.children(clone):
+                pending.append(child)
+
+        for clone in order:
+            kind = Grammar.kind(clone)
+            if kind == Grammar.SEQ or kind == Grammar.ALT:
+                clone.p1 = clones[clone.p1]
+                clone.p2 = clones[clone.p2]
+            elif kind != Grammar.WORD and kind != Grammar.OPAQUE:
+                clone.p = clones[clone.p]
+        self.guard(order)
+        return clones[start]
+
+    def children(self, node):
+        """Дочерние узлы исходного графа, на которые ссылается копия"""
+        if isinstance(node, (WordParser, LexiconParser)):
+            return ()
+        return Grammar.children(node, Grammar.kind(node))
+
+    def alternatives(self, node):
+        """Разворачивает цепочку AltParser и собирает подряд идущие
+        WordParser в LexiconParser, сохраняя порядок альтернатив"""
+        flat = []
+        pending = [node]
+        while pending:
+            item = pending.pop()
+            if Grammar.kind(item) == Grammar.ALT:
+                pending.extend((item.p2, item.p1))
+            else:
+                flat.append(item)
+        groups = []
+        for item in flat:
+            if isinstance(item, WordParser):
+                if groups and isinstance(groups[-1], list):
+                    groups[-1].append(item.w)
+                else:
+                    groups.append([item.w])
+            else:
+                groups.append(item)
+        groups = [LexiconParser(group) if isinstance(group, list) else group for group in groups]
+        if len(groups) == 1:
+            return groups[0]
+        result = FirstAltParser(groups[0], groups[1])
+        for group in groups[2:]:
+            result = FirstAltParser(result, group)
+        return result
+
+    def guard(self, nodes):
+        """Вычисляет FIRST и пустоту итерацией до неподвижной точки
+        и записывает их в узлы FirstAltParser и FirstSeqParser.
+        ANY (None) --- FIRST неизвестно"""
+        first = {node: frozenset() for node in nodes}
+        nullable = dict.fromkeys(nodes, False)
+        changed = True
+        while changed:
+            changed = False
+            for node in nodes:
+                f, n = self.first(node, first, nullable)
+                if f != first[node] or n != nullable[node]:
+                    first[node], nullable[node] = f, n
+                    changed = True
+
+        def entry(node):
+            return None if nullable[node] else first[node]
+
+        for node in nodes:
+            if isinstance(node, FirstAltParser):
+                node.first1, node.first2 = entry(node.p1), entry(node.p2)
+            elif isinstance(node, FirstSeqParser):
+                node.first2 = entry(node.p2)
+
+    def first(self, node, first, nullable):
+        """Один шаг вычисления (FIRST, пустота) для узла"""
+        if isinstance(node, WordParser):
+            return frozenset((node.w,)), False
+        if isinstance(node, LexiconParser):
+            return frozenset(node.counts), False
+        kind = Grammar.kind(node)
+        if kind == Grammar.OPAQUE:
+            return None, True
+        if kind == Grammar.ALT:
+            f1, f2 = first[node.p1], first[node.p2]
+            return (None if f1 is None or f2 is None else f1 | f2), nullable[node.p1] or nullable[node.p2]
+        if kind == Grammar.SEQ:
+            f = first[node.p1]
+            if nullable[node.p1]:
+                f2 = first[node.p2]
+                f = None if f is None or f2 is None else f | f2
+            return f, nullable[node.p1] and nullable[node.p2]
+        return first[node.p], nullable[node.p]
 
 def word(w):
     """Сокращение для конструктора WordParser"""
@@ -168,6 +1274,10 @@ def whole(p):
     """Сокращение для конструктора WholeParser"""
     return WholeParser(p)
 
+def optimize(p):
+    """Сокращение для Optimizer().optimize"""
+    return Optimizer().optimize(p)
+
 N = (word('fox') | word('wolf') | word('ant') | word('table')) @ 'N'
 Adj = (word('quick') | word('brown') | word('table') | word('caught') |
        word('adorable')) @ 'Adj'
@@ -193,6 +1303,15 @@ class FilterValidArticle(FilterParser):
             return re.match('[aeiou]', c.words[1])
         return True
 
+    def decide(self, node, children):
+        """Для конкатенации предикат зависит только от метки первой части
+        и слов отрезка, поэтому он проверяется на заготовке с этими данными,
+        если у первой части одна возможная метка"""
+        if node.kind != Grammar.SEQ or len(children[0].tags()) != 1:
+            return None
+        tag, = children[0].tags()
+        return bool(self.predicate(Constituent(children=(Constituent(tag), Constituent()), words=node.words)))
+
 NP0 = recursive(lambda NP0: (N | Adj + NP0) @ 'NP')
 NP = FilterValidArticle(Compl + NP0) @ 'NP'
 
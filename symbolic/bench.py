@@ -0,0 +1,404 @@
+import sys
+import json
+import pickle
+import time
+import random
+import argparse
+import platform
+import tracemalloc
+import math
+import os
+import numpy as np
+from expr import Expression, SimplifyCache, Equation, Identifier, Constant, Addition, Multiplication, Division
+from textplot import TextAxes
+
+def timeit(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def bench_compile(formula='(x^2 + 3*x - 1) / (x^2 + 1) - 2^x', scalar_limit=10**5):
+    expr = Expression.parse(formula)
+    compiled = expr.compile()
+    print(f'{"points":>10} {"scalar":>10} {"array":>10} {"compiled":>10} {"array MB":>10} {"compiled MB":>12}')
+    for n in (10**3, 10**4, 10**5, 10**6, 10**7):
+        xs = np.linspace(-10.0, 10.0, n)
+        if n <= scalar_limit:
+            scalar = f'{timeit(lambda: [expr.evaluate({"x": x}) for x in xs.tolist()]):10.4f}'
+        else:
+            scalar = f'{"-":>10}'
+        array = min(timeit(expr.evaluate, {'x': xs}) for _ in range(3))
+        fast = min(timeit(compiled, {'x': xs}) for _ in range(3))
+        memory = []
+        for func in (expr.evaluate, compiled):
+            tracemalloc.start()
+            func({'x': xs})
+            memory.append(tracemalloc.get_traced_memory()[1] / 2**20)
+            tracemalloc.stop()
+        print(f'{n:>10} {scalar} {array:10.4f} {fast:10.4f} {memory[0]:10.1f} {memory[1]:12.1f}')
+
+def bench_intern(sizes=(100, 200, 400, 800)):
+    print(f'{"terms":>10} {"plain":>10} {"interned":>10}')
+    for n in sizes:
+        term = ' + '.join(f'(x{i % 10} * (y + {i % 7}))' for i in range(n))
+        formula = f'({term}) - ({term})'
+        times = []
+        for intern in (False, True):
+            Expression.INTERN = intern
+            expr = Expression.parse(formula)
+            times.append(timeit(expr.simplify))
+        Expression.INTERN = False
+        print(f'{n:>10} {times[0]:10.4f} {times[1]:10.4f}')
+
+def bench_simplify_cache(depths=(4, 6, 8), repeats=20):
+    print(f'{"depth":>10} {"uncached":>10} {"cached":>10} {"hit rate":>10}')
+    for depth in depths:
+        formula = 'x'
+        for i in range(depth):
+            formula = f'({formula}) / (y{i} + {i + 1}) + z{i} * 2'
+        times = []
+        for cache in (None, SimplifyCache()):
+            Expression.SIMPLIFY_CACHE = cache
+            times.append(timeit(lambda: [Expression.parse(f'{formula} - w{k % 3}').simplify()
+                                         for k in range(repeats)]))
+        stats = cache.stats()
+        print(f'{depth:>10} {times[0]:10.4f} {times[1]:10.4f} '
+              f'{stats["hits"] / max(stats["hits"] + stats["misses"], 1):10.2%}')
+    Expression.SIMPLIFY_CACHE = SimplifyCache()
+
+def bench_parse(sizes=(10**3, 10**4, 10**5)):
+    print(f'{"terms":>10} {"tokens":>10} {"wide tok/s":>12} {"deep tok/s":>12}')
+    for n in sizes:
+        wide = ' + '.join(f'{i} * x{i % 10}' for i in range(n))
+        deep = '(' * n + 'x' + ' + 1)' * n
+        tokens = len(Expression.TOKEN_RE.findall(wide))
+        wide_time = timeit(Expression.parse, wide)
+        deep_time = timeit(Expression.parse, deep)
+        deep_tokens = len(Expression.TOKEN_RE.findall(deep))
+        print(f'{n:>10} {tokens:>10} {tokens / wide_time:12.0f} {deep_tokens / deep_time:12.0f}')
+
+def bench_binomials(sizes=(4, 8, 10, 12, 50, 200), rewrite_limit=12):
+    print(f'{"factors":>10} {"rewrite":>10} {"polynomial":>10}')
+    for n in sizes:
+        formula = ' * '.join(f'(x + {i + 1})' for i in range(n))
+        times = []
+        for expand in (False, True):
+            if not expand and n > rewrite_limit:
+                times.append(None)
+                continue
+            Expression.EXPAND_POLYNOMIALS = expand
+            Expression.SIMPLIFY_CACHE.clear()
+            times.append(timeit(Expression.parse(formula).simplify))
+        Expression.EXPAND_POLYNOMIALS = True
+        rewrite = f'{"-":>10}' if times[0] is None else f'{times[0]:10.4f}'
+        print(f'{n:>10} {rewrite} {times[1]:10.4f}')
+
+def bench_solve_system(sizes=(10, 100, 1000), terms=5):
+    print(f'{"unknowns":>10} {"parse":>10} {"solve":>10}')
+    rng = np.random.default_rng(0)
+    for n in sizes:
+        formulas = []
+        for i in range(n):
+            cols = rng.choice(n, size=min(terms, n), replace=False)
+            lhs = ' + '.join(f'{rng.integers(1, 10)} * x{j}' for j in sorted(set(cols) | {i}))
+            formulas.append(f'{lhs} = {rng.integers(-50, 50)}')
+        start = time.perf_counter()
+        equations = [Expression.parse(f) for f in formulas]
+        parse_time = time.perf_counter() - start
+        solve_time = timeit(Equation.solve_system, equations, [f'x{j}' for j in range(n)])
+        print(f'{n:>10} {parse_time:10.4f} {solve_time:10.4f}')
+
+def traced(func, *args):
+    tracemalloc.start()
+    result = func(*args)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return result, size
+
+class DictIdentifier:
+    # the nodes as they were before __slots__ (baseline 8bd33c7): plain
+    # instances that keep their operands in __dict__
+    def __init__(self, name):
+        self.name = name
+
+class DictConstant:
+    def __init__(self, value):
+        self.value = value
+
+class DictUnaryOp:
+    def __init__(self, arg):
+        self.arg = arg
+
+class DictBinaryOp:
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+def rebuild(expr, dict_based=False, materialize=False):
+    # a copy of the tree, either of the current node classes or of the dict-based ones;
+    # since Python 3.11 an instance __dict__ is only created when something asks for it
+    # (vars(), pickle), materialize=True creates it as older versions always did
+    nodes = {}
+    for node in expr.topological():
+        if isinstance(node, Identifier):
+            cls, args = DictIdentifier, (node.name,)
+        elif isinstance(node, Constant):
+            cls, args = DictConstant, (node.value,)
+        else:
+            cls = DictUnaryOp if len(node.children()) == 1 else DictBinaryOp
+            args = tuple(nodes[id(child)] for child in node.structure())
+        nodes[id(node)] = cls(*args) if dict_based else type(node)(*args)
+        if materialize:
+            vars(nodes[id(node)])
+    return nodes[id(expr)]
+
+def bench_memory(sizes=(10**3, 10**4, 10**5)):
+    print(f'{"terms":>10} {"dict tree":>12} {"with dicts":>12} {"slots tree":>12} {"tape":>12} {"bytes":>12}')
+    for n in sizes:
+        formula = ' + '.join(f'{i % 100} * x{i % 10} ^ 2' for i in range(n))
+        expr = Expression.parse(formula)
+        dict_tree, dict_size = traced(rebuild, expr, True)
+        del dict_tree
+        dict_tree, materialized_size = traced(rebuild, expr, True, True)
+        del dict_tree
+        slots_tree, slots_size = traced(rebuild, expr)
+        tape, tape_size = traced(expr.to_tape)
+        print(f'{n:>10} {dict_size:12} {materialized_size:12} {slots_size:12} {tape_size:12} '
+              f'{len(tape.serialize()):12}')
+
+def bench_partial_evaluate(terms=200, points=200):
+    formula = ' + '.join(f'(p{i % 5} * p{(i + 1) % 5} + {i}) * x^{i % 4}' for i in range(terms))
+    expr = Expression.parse(formula)
+    params = {f'p{i}': i + 0.5 for i in range(5)}
+    full = timeit(lambda: [expr.evaluate(dict(params, x=x)) for x in range(points)])
+    residual = expr.partial_evaluate(params)
+    partial = timeit(lambda: [residual.evaluate({'x': x}) for x in range(points)])
+    fold = timeit(expr.partial_evaluate, params)
+    print(f'{"full":>10} {"fold":>10} {"residual":>10}')
+    print(f'{full:10.4f} {fold:10.4f} {partial:10.4f}')
+
+def bench_batch(count=400, size=12):
+    expressions = [Expression.parse(generate_deep(size, seed)) for seed in range(count)]
+    print(f'{"pickle B":>10} {"tape B":>10} {"pickle s":>10} {"tape s":>10}')
+    pickled = timeit(lambda: [pickle.loads(pickle.dumps(e)) for e in expressions])
+    taped = timeit(lambda: [Expression.loads(e.dumps()) for e in expressions])
+    print(f'{sum(len(pickle.dumps(e)) for e in expressions):>10} {sum(len(e.dumps()) for e in expressions):>10} '
+          f'{pickled:10.4f} {taped:10.4f}')
+    print(f'{"serial":>10} {"pool":>10}')
+    Expression.SIMPLIFY_CACHE.clear()
+    serial = timeit(lambda: [e.simplify() for e in expressions])
+    pool = timeit(Expression.simplify_many, expressions)
+    print(f'{serial:10.4f} {pool:10.4f}')
+
+def generate_shared(depth):
+    # every level uses the previous one twice, so the tree doubles while the DAG grows linearly
+    node = Identifier('x0')
+    for i in range(depth):
+        scaled = Addition(Multiplication(node, Identifier(f'x{i % 8}')), Constant(1.0))
+        node = Division(scaled, Addition(node, Constant(2.0)))
+    return node
+
+def tree_size(expressions):
+    sizes = {}
+    for expr in expressions:
+        for node in expr.topological():
+            sizes[id(node)] = 1 + sum(sizes[id(child)] for child in node.children())
+    return sum(sizes[id(expr)] for expr in expressions)
+
+def dag_size(expressions):
+    return len({id(node) for expr in expressions for node in expr.topological()})
+
+def bench_diff(depths=(8, 12, 16)):
+    print(f'{"depth":>6} {"dag":>6} {"tree":>8} {"grad dag":>9} {"grad tree":>10} '
+          f'{"evaluate":>10} {"reverse":>10} {"symbolic":>10} {"max error":>10}')
+    for depth in depths:
+        expr = generate_shared(depth)
+        mapping = {f'x{i}': 0.5 + i / 8 for i in range(8)}
+        gradient = {}
+        symbolic = timeit(lambda: gradient.update(expr.gradient(list(mapping))))
+        evaluate = timeit(expr.evaluate, mapping)
+        reverse = timeit(expr.evaluate_gradient, mapping)
+        error = max(expr.check_gradient(mapping).values())
+        print(f'{depth:6} {dag_size([expr]):6} {tree_size([expr]):8} {dag_size(gradient.values()):9} '
+              f'{tree_size(gradient.values()):10} {evaluate:10.4f} {reverse:10.4f} {symbolic:10.4f} {error:10.2e}')
+
+def bench_tape_sharing(depths=(8, 12, 16)):
+    # gradients share most of their subtrees: the tape stores each distinct node once,
+    # so it has to stay linear in the DAG and round-trip to the same tape
+    print(f'{"depth":>6} {"grad dag":>9} {"entries":>8} {"tape B":>8} {"pickle B":>9} '
+          f'{"dumps s":>8} {"round trip":>11}')
+    for depth in depths:
+        expr = generate_shared(depth)
+        mapping = {f'x{i}': 0.5 + i / 8 for i in range(8)}
+        gradient = expr.gradient(list(mapping))
+        _, values = expr.evaluate_gradient(mapping)
+        nodes = entries = size = 0
+        same = True
+        for name, derivative in gradient.items():
+            tape = derivative.to_tape()
+            assert len(tape) <= dag_size([derivative]), (depth, name, len(tape))
+            data = derivative.dumps()
+            again = Expression.loads(data).to_tape()
+            same = same and again.names == tape.names and np.isclose(again.evaluate(mapping), values[name]) and \
+                all(np.array_equal(a, b) for a, b in zip((tape.ops, tape.args, tape.constants),
+                                                         (again.ops, again.args, again.constants)))
+            nodes += dag_size([derivative])
+            entries += len(tape)
+            size += len(data)
+        dumps = timeit(lambda: [derivative.dumps() for derivative in gradient.values()])
+        # pickle writes the shared subtrees once too, but recursively
+        pickled = f'{sum(len(pickle.dumps(d)) for d in gradient.values()):9}' if depth <= 8 else f'{"-":>9}'
+        print(f'{depth:6} {nodes:9} {entries:8} {size:8} {pickled} {dumps:8.4f} {"ok" if same else "differs":>11}')
+
+PLOT_FUNCTIONS = {'sin': np.sin, 'log': np.log, 'erf': np.vectorize(math.erf)}
+PLOT_LEVELS = {'level0.txt': 0, 'level1.txt': 1, 'level2.txt': 2,
+               'level3-1.txt': 3, 'level3-2.txt': 3, 'level3-3.txt': 3}
+
+def bench_textplot(folder=os.path.join(os.path.dirname(__file__), '..', 'exercise1'),
+                   sizes=(10**2, 10**3, 3 * 10**3)):
+    for filename, level in PLOT_LEVELS.items():
+        path = os.path.join(folder, filename)
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            head, *expected = f.read().split('\n')[:-1]
+        _, name, minx, maxx, dx = head.split()
+        lines = TextAxes(level=level).render(PLOT_FUNCTIONS[name], float(minx), float(maxx), float(dx))
+        print(f'{filename:>12} {"ok" if lines == expected else "differs"}')
+    print(f'{"columns":>10} {"rows":>10} {"seconds":>10}')
+    for size in sizes:
+        axes = TextAxes()
+        seconds = timeit(axes.plot_function, lambda x: np.sin(x) + np.log(x), np.linspace(0, 10, size))
+        print(f'{size:10} {len(axes.lines):10} {seconds:10.4f}')
+
+def generate_deep(depth, seed=0):
+    rng = random.Random(seed)
+    formula = 'x0'
+    for i in range(depth):
+        operand = rng.choice(['x', 'y', 'z']) + str(rng.randrange(10)) if rng.random() < 0.7 else str(rng.randrange(1, 10))
+        op = rng.choice('+-*')
+        formula = f'({formula}) {op} {operand}' if rng.random() < 0.5 else f'{operand} {op} ({formula})'
+    return formula
+
+def generate_wide(n, seed=0):
+    rng = random.Random(seed)
+    return ' + '.join(f'({rng.randrange(1, 10)} * x{rng.randrange(10)} - y{rng.randrange(10)} * z{rng.randrange(10)})'
+                      for i in range(n))
+
+def generate_product(n, seed=0):
+    return ' * '.join(f'(x + {i + 1})' for i in range(n))
+
+def generate_sum(n, seed=0):
+    return ' + '.join(f'{i % 9 + 1} * x{i}' for i in range(n)) + ' + 3 * v'
+
+GENERATORS = {
+    'deep': (generate_deep, (25, 50, 100)),
+    'wide': (generate_wide, (50, 100, 200)),
+    'product': (generate_product, (5, 10, 20)),
+    'sum': (generate_sum, (50, 100, 200)),
+}
+
+def prepare(formula):
+    expr = Expression.parse(formula)
+    return expr, {name: 1.5 for name in expr.to_tape().names}
+
+OPERATIONS = {
+    'parse': (('deep', 'wide', 'product', 'sum'), lambda formula: lambda: Expression.parse(formula)),
+    'simplify': (('deep', 'wide', 'product', 'sum'), lambda formula: prepare(formula)[0].simplify),
+    'evaluate': (('deep', 'wide', 'product', 'sum'),
+                 lambda formula: (lambda expr, values: lambda: expr.evaluate(values))(*prepare(formula))),
+    'substitute': (('deep', 'wide', 'sum'),
+                   lambda formula: (lambda expr, values: lambda: expr.substitute({'x1': Expression.parse('a + b')}))(*prepare(formula))),
+    'linear': (('sum',), lambda formula: lambda: Expression.parse(formula).simplify().linear('v')),
+    'solve': (('sum',), lambda formula: lambda: Expression.parse(f'{formula} = 0').solve('v')),
+}
+
+def measure(make, repeats=3):
+    best = None
+    for _ in range(repeats):
+        Expression.SIMPLIFY_CACHE.clear()
+        func = make()
+        elapsed = timeit(func)
+        best = elapsed if best is None else min(best, elapsed)
+    Expression.SIMPLIFY_CACHE.clear()
+    func = make()
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return best, peak
+
+def run_suite(repeats=3):
+    results = []
+    for op, (generators, factory) in OPERATIONS.items():
+        for name in generators:
+            generate, sizes = GENERATORS[name]
+            for size in sizes:
+                formula = generate(size)
+                result = {'operation': op, 'generator': name, 'size': size}
+                try:
+                    result['seconds'], result['peak_bytes'] = measure(lambda: factory(formula), repeats)
+                    print(f'{op:>10} {name:>8} {size:>8} {result["seconds"]:10.4f} {result["peak_bytes"]:12}')
+                except Exception as exc:
+                    result['error'] = f'{type(exc).__name__}: {exc}'
+                    print(f'{op:>10} {name:>8} {size:>8} {result["error"]}')
+                results.append(result)
+    return {'python': platform.python_version(), 'numpy': np.__version__,
+            'timestamp': time.time(), 'results': results}
+
+def compare(report, baseline, threshold=1.5, min_seconds=1e-3):
+    reference = {(r['operation'], r['generator'], r['size']): r for r in baseline['results']}
+    regressions = []
+    for r in report['results']:
+        base = reference.get((r['operation'], r['generator'], r['size']))
+        if base is None or 'error' in base:
+            continue
+        if 'error' in r:
+            regressions.append((r['operation'], r['generator'], r['size'], float('inf')))
+            continue
+        if base['seconds'] < min_seconds:
+            continue
+        ratio = r['seconds'] / base['seconds']
+        if ratio > threshold:
+            regressions.append((r['operation'], r['generator'], r['size'], ratio))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmarks for the symbolic engine')
+    parser.add_argument('--suite', action='store_true', help='run the regression suite instead of the demos')
+    parser.add_argument('--output', help='write suite results to this JSON file')
+    parser.add_argument('--baseline', help='compare suite results against this JSON file')
+    parser.add_argument('--threshold', type=float, default=1.5, help='maximal allowed slowdown ratio')
+    parser.add_argument('--repeats', type=int, default=3)
+    args = parser.parse_args(argv)
+
+    if not args.suite:
+        bench_compile()
+        bench_intern()
+        bench_simplify_cache()
+        bench_parse()
+        bench_binomials()
+        bench_solve_system()
+        bench_memory()
+        bench_partial_evaluate()
+        bench_batch()
+        bench_textplot()
+        bench_diff()
+        bench_tape_sharing()
+        return 0
+
+    report = run_suite(args.repeats)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        for op, name, size, ratio in regressions:
+            print(f'REGRESSION {op} {name} {size}: {ratio:.2f}x slower', file=sys.stderr)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,4 +1,138 @@
 import re
+import math
+import struct
+import operator
+import weakref
+import multiprocessing
+from collections import OrderedDict
+import numpy as np
+
+class SimplifyCache:
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, node):
+        result = self.entries.get(node)
+        if result is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(node)
+        return result
+
+    def put(self, node, result):
+        self.entries[node] = result
+        self.entries.move_to_end(node)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def stats(self):
+        return {'size': len(self.entries), 'maxsize': self.maxsize,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+class Polynomial:
+
+    def __init__(self, terms=None):
+        self.terms = {} if terms is None else terms
+
+    @classmethod
+    def constant(cls, value):
+        return cls({frozenset(): value} if value != 0 else {})
+
+    @classmethod
+    def atom(cls, node, exponent=1):
+        return cls({frozenset([(node, exponent)]): 1.0})
+
+    def numeric(self):
+        if not self.terms:
+            return 0.0
+        if len(self.terms) == 1 and frozenset() in self.terms:
+            return self.terms[frozenset()]
+        return None
+
+    def accumulate(self, other, scale=1.0):
+        for monomial, coef in other.terms.items():
+            coef = self.terms.get(monomial, 0.0) + coef * scale
+            if coef == 0:
+                self.terms.pop(monomial, None)
+            else:
+                self.terms[monomial] = coef
+        return self
+
+    def __add__(self, other):
+        return Polynomial(dict(self.terms)).accumulate(other)
+
+    def __sub__(self, other):
+        return Polynomial(dict(self.terms)).accumulate(other, -1.0)
+
+    def __neg__(self):
+        return Polynomial({monomial: -coef for monomial, coef in self.terms.items()})
+
+    def __mul__(self, other):
+        result = Polynomial()
+        for m1, c1 in self.terms.items():
+            for m2, c2 in other.terms.items():
+                powers = dict(m1)
+                for atom, exponent in m2:
+                    powers[atom] = powers.get(atom, 0) + exponent
+                monomial = frozenset((atom, exponent) for atom, exponent in powers.items() if exponent != 0)
+                coef = result.terms.get(monomial, 0.0) + c1 * c2
+                if coef == 0:
+                    result.terms.pop(monomial, None)
+                else:
+                    result.terms[monomial] = coef
+        return result
+
+    def __pow__(self, n):
+        if n == 0:
+            return Polynomial.constant(1.0)
+        if len(self.terms) == 1:
+            (monomial, coef), = self.terms.items()
+            return Polynomial({frozenset((atom, exponent * n) for atom, exponent in monomial): coef ** n})
+        result = Polynomial.constant(1.0)
+        base = self
+        while n > 0:
+            if n & 1:
+                result = result * base
+            n >>= 1
+            if n:
+                base = base * base
+        return result
+
+    def to_expression(self):
+        names = {}
+
+        def name(atom):
+            if atom not in names:
+                names[atom] = str(atom)
+            return names[atom]
+
+        def factors(monomial):
+            return sorted(monomial, key=lambda factor: (name(factor[0]), factor[1]))
+
+        result = None
+        for monomial in sorted(self.terms, key=lambda m: (-sum(e for a, e in m),
+                                                           [(name(a), e) for a, e in factors(m)])):
+            coef = self.terms[monomial]
+            term = None if coef == 1 and monomial else Constant(coef)
+            for atom, exponent in factors(monomial):
+                factor = atom if exponent == 1 else PowerOp(atom, Constant(float(exponent)))
+                term = factor if term is None else Multiplication(term, factor)
+            result = term if result is None else Addition(result, term)
+        return Constant(0.0) if result is None else result
 
 class Expression:
 
@@ -8,81 +142,452 @@ class Expression:
     IDENTIFIER_FUNC = None
     CONSTANT_FUNC = None
     MAX_PRECEDENCE = 1000
+    TOKEN_RE = re.compile(r'(?P<identifier>[a-zA-Z][a-zA-Z0-9]*)|'
+                          r'(?P<constant>[0-9]+(?:\.[0-9]*)?(?:[eE][+-]?[0-9]+)?)|'
+                          r'(?P<operator>[-+*/^()=])')
+    PYTHON_OP = None
+    NUMPY_OP = None
+
+    EXPAND_POLYNOMIALS = True
+
+    INTERN = False
+    INTERN_TABLE = weakref.WeakValueDictionary()
+
+    SIMPLIFY_CACHE = SimplifyCache()
+
+    NORMAL_FORM = False
+
+    COMPILE_CHUNK = 2**14
+
+    __slots__ = ('structure_hash', 'interned', 'normal', 'initialized', '__weakref__')
+
+    def __new__(cls, *args):
+        if Expression.INTERN and args:
+            # 1, 1.0 and True are equal but print differently
+            key = (cls,) + args + tuple(type(arg) for arg in args)
+            node = Expression.INTERN_TABLE.get(key)
+            if node is not None:
+                return node
+        node = super().__new__(cls)
+        node.structure_hash = None
+        node.interned = False
+        node.initialized = False
+        node.normal = cls.NORMAL_FORM
+        if Expression.INTERN and args:
+            node.interned = True
+            cls.__init__(node, *args)
+            node.initialized = True
+            Expression.INTERN_TABLE[key] = node
+        return node
+
+    def __eq__(self, other):
+        pending = [(self, other)]
+        while pending:
+            a, b = pending.pop()
+            if a is b:
+                continue
+            if type(a) is not type(b) or a.interned and b.interned or hash(a) != hash(b):
+                return False
+            for x, y in zip(a.structure(), b.structure()):
+                if isinstance(x, Expression):
+                    pending.append((x, y))
+                elif x != y:
+                    return False
+        return True
+
+    def __hash__(self):
+        if self.structure_hash is not None:
+            return self.structure_hash
+        pending = [self]
+        while pending:
+            node = pending[-1]
+            children = [child for child in node.structure()
+                        if isinstance(child, Expression) and child.structure_hash is None]
+            if children:
+                pending.extend(children)
+            else:
+                pending.pop()
+                node.structure_hash = hash((type(node),) + node.structure())
+        return self.structure_hash
+
+    def structure(self):
+        return ()
     
     @classmethod
     def parse(self, input):
-        tokens = re.findall(r'[a-zA-Z][a-zA-Z0-9]*|[0-9]+(?:\.[0-9]*)?(?:[eE][+-]?[0-9]+)?|[-+*/^()=]', input)
-
-        def parse_primary():
-            nonlocal tokens
+        tokens = [(m.lastgroup, m.group()) for m in self.TOKEN_RE.finditer(input)]
+        pos = 0
+        prec = self.MAX_PRECEDENCE
+        # pending operators: (kind, enclosing precedence, constructor, left operand)
+        stack = []
 
-            cur_token = tokens[0]
-            tokens = tokens[1:]
-            if re.match(r'[a-zA-Z]', cur_token):
-                return self.IDENTIFIER_FUNC(cur_token)
-            if re.match(r'\d', cur_token):
-                return self.CONSTANT_FUNC(float(cur_token))
-            if cur_token == '(':
-                result = parse_subexpr(self.MAX_PRECEDENCE)
-                if not tokens or tokens[0] != ')':
-                    raise SyntaxError("unexpected token")
-                tokens = tokens[1:]
-                return result
-            raise SyntaxError(f"unexpected token {tokens}")
-        
-        def parse_subexpr(prec):
-            nonlocal tokens
-
-            left = None
-            if not tokens:
-                return None
-            cur_token = tokens[0]
-            if cur_token in self.UNARY_OPS:
-                tokens = tokens[1:]
+        while True:
+            if pos == len(tokens):
+                raise SyntaxError("unexpected end of input")
+            kind, cur_token = tokens[pos]
+            pos += 1
+            if kind == 'operator' and cur_token in self.UNARY_OPS:
                 op_prec, f = self.UNARY_OPS[cur_token]
-                left = f(parse_subexpr(op_prec))
+                stack.append(('unary', prec, f, None))
+                prec = op_prec
+                continue
+            if cur_token == '(':
+                stack.append(('paren', prec, None, None))
+                prec = self.MAX_PRECEDENCE
+                continue
+            if kind == 'identifier':
+                left = self.IDENTIFIER_FUNC(cur_token)
+            elif kind == 'constant':
+                left = self.CONSTANT_FUNC(float(cur_token))
             else:
-                left = parse_primary()
-            while tokens:
-                cur_token = tokens[0]
-                if cur_token not in self.BINARY_OPS:
-                    break
-                op_prec, left_assoc, f = self.BINARY_OPS[cur_token]
-                if op_prec > prec:
+                raise SyntaxError(f"unexpected token {cur_token}")
+
+            while True:
+                cur_token = tokens[pos][1] if pos < len(tokens) else None
+                if cur_token in self.BINARY_OPS and self.BINARY_OPS[cur_token][0] <= prec:
+                    op_prec, left_assoc, f = self.BINARY_OPS[cur_token]
+                    pos += 1
+                    stack.append(('binary', prec, f, left))
+                    prec = op_prec - 1 if left_assoc else op_prec
                     break
-                tokens = tokens[1:]
-                if left_assoc:
-                    op_prec -= 1
-                right = parse_subexpr(op_prec)
-                left = f(left, right)
-            return left
-
-        result = parse_subexpr(self.MAX_PRECEDENCE)
-        if tokens:
-            raise SyntaxError(f"trailing garbage: {tokens}")
-        return result
+                if not stack:
+                    if pos < len(tokens):
+                        raise SyntaxError(f"trailing garbage: {[t for k, t in tokens[pos:]]}")
+                    return left
+                op_kind, prec, f, op_left = stack.pop()
+                if op_kind == 'unary':
+                    left = f(left)
+                elif op_kind == 'binary':
+                    left = f(op_left, left)
+                elif cur_token == ')':
+                    pos += 1
+                else:
+                    raise SyntaxError("unexpected token")
 
     def substitute(self, mapping):
         return self;
 
+    def partial_evaluate(self, mapping):
+        return self
+
+    def fold(self):
+        if self.PYTHON_OP is None:
+            return self
+        try:
+            return Constant(self.evaluate({}))
+        except ArithmeticError:
+            return self
+
     def evaluate(self, mapping):
         raise ValueError("cannot evaluate")
 
+    def compile(self):
+        # one ufunc call per node, in topological order, so that neither the width
+        # nor the depth of the tree hits the parser's nesting limits; the inputs are
+        # broadcast to the result shape, and an intermediate array is written into
+        # the buffer of an operand used for the last time (or of an earlier one
+        # that is no longer needed), so that few arrays are alive at once
+        names = set()
+        # the operand that needs more arrays at once is computed first (Sethi-Ullman order)
+        need = {}
+        for node in self.topological():
+            needs = sorted((need[id(child)] for child in node.children()), reverse=True)
+            need[id(node)] = max([n + i for i, n in enumerate(needs)] + [1]) if needs else 0
+        order, seen = [], set()
+        pending = [(self, False)]
+        while pending:
+            node, visited = pending.pop()
+            if visited:
+                order.append(node)
+            elif id(node) not in seen:
+                seen.add(id(node))
+                pending.append((node, True))
+                pending.extend((child, False) for child in sorted(node.children(), key=lambda child: need[id(child)]))
+        last = {}
+        for i, node in enumerate(order):
+            for child in node.children():
+                last[id(child)] = i
+        temps, varying, lines, free = {}, set(), [], []
+        for i, node in enumerate(order):
+            children = node.children()
+            args = [temps[id(child)] for child in children]
+            if not children:
+                source = node.compile_source(args, None, names)
+                temps[id(node)] = source if source.isidentifier() else f'({source})'
+                if isinstance(node, Identifier):
+                    varying.add(id(node))
+                continue
+            dead = []
+            for child in children:
+                if last[id(child)] == i and child.children() and id(child) in varying \
+                        and temps[id(child)] not in dead:
+                    dead.append(temps[id(child)])
+            if any(id(child) in varying for child in children):
+                varying.add(id(node))
+                free.extend(dead)
+                out = free.pop() if free else None
+            else:
+                out = None
+            temps[id(node)] = out or f't{len(lines)}'
+            lines.append(f'    {temps[id(node)]} = {node.compile_source(args, out, names)}\n')
+        names = sorted(names)
+        namespace = {'np': np}
+        exec(f"def func({', '.join('v_' + name for name in names)}):\n"
+             f"{''.join(lines)}"
+             f"    return {temps[id(self)]}\n", namespace)
+        func = namespace['func']
+
+        def evaluator(mapping):
+            shape = np.broadcast_shapes(*(np.shape(v) for v in mapping.values())) if mapping else ()
+            # a 0-d array is computed as a 1-element one, ufuncs do not write into scalars
+            arrays = [np.broadcast_to(np.asarray(mapping[name], dtype=float), shape or (1,)) for name in names]
+            # large inputs are computed by slices along the first axis that keep
+            # the intermediate arrays in cache
+            rows = (shape or (1,))[0]
+            step = max(1, self.COMPILE_CHUNK * rows // max(np.prod(shape, dtype=int), 1))
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                if not names or step >= rows:
+                    result = func(*arrays)
+                else:
+                    result = np.empty(shape)
+                    for start in range(0, rows, step):
+                        result[start:start + step] = func(*(array[start:start + step] for array in arrays))
+            return np.broadcast_to(result, shape) if np.ndim(result) == 0 else result.reshape(shape)
+        return evaluator
+
+    def compile_source(self, args, out, names):
+        if self.NUMPY_OP is None:
+            raise ValueError("cannot compile")
+        return f"np.{self.NUMPY_OP}({', '.join(args)}{f', out={out}' if out else ''})"
+
     def numeric(self):
         return None
 
     def simplify(self):
+        if self.normal:
+            return self
+        cache = Expression.SIMPLIFY_CACHE
+        result = cache.get(self) if cache is not None else None
+        if result is None:
+            result = self.simplify_tree()
+            result.normal = True
+            if cache is not None:
+                cache.put(self, result)
+        return result
+
+    def simplify_tree(self):
         return self
     
     def simplify_local(self):
         return self
 
+    def polynomial(self):
+        return Polynomial.atom(self)
+
+    def expand(self):
+        return self.polynomial().to_expression()
+
+    def children(self):
+        return tuple(child for child in self.structure() if isinstance(child, Expression))
+
+    def topological(self):
+        # every distinct node once, children before parents
+        order, seen = [], set()
+        pending = [(self, False)]
+        while pending:
+            node, visited = pending.pop()
+            if visited:
+                order.append(node)
+            elif id(node) not in seen:
+                seen.add(id(node))
+                pending.append((node, True))
+                pending.extend((child, False) for child in node.children())
+        return order
+
+    @staticmethod
+    def sum_of(a, b):
+        if a.numeric() == 0:
+            return b
+        if b.numeric() == 0:
+            return a
+        if isinstance(a, Constant) and isinstance(b, Constant):
+            return Constant(a.value + b.value)
+        return Addition(a, b)
+
+    @staticmethod
+    def product_of(a, b):
+        if isinstance(a, Constant) and isinstance(b, Constant):
+            return Constant(a.value * b.value)
+        for x, y in ((a, b), (b, a)):
+            n = x.numeric()
+            if n == 0:
+                return Constant(0.0)
+            if n == 1:
+                return y
+            if n == -1:
+                return UnaryMinus(y)
+        return Multiplication(a, b)
+
+    def evaluate_local(self, args, mapping):
+        if type(self) not in Tape.OPERATORS:
+            raise ValueError("cannot evaluate")
+        return Tape.OPERATORS[type(self)](*args)
+
+    def partials(self):
+        raise ValueError(f"cannot differentiate {type(self).__name__}")
+
+    def partial_values(self, args, value):
+        raise ValueError(f"cannot differentiate {type(self).__name__}")
+
+    def diff(self, var):
+        derivatives = {}
+        for node in self.topological():
+            if isinstance(node, Identifier):
+                derivative = Constant(1.0 if node.name == var else 0.0)
+            else:
+                derivative = Constant(0.0)
+                children = node.children()
+                inner = [derivatives[id(child)] for child in children]
+                if any(d.numeric() != 0 for d in inner):
+                    for d, partial in zip(inner, node.partials()):
+                        if d.numeric() == 0:
+                            continue
+                        if partial is None:
+                            raise ValueError(f"cannot differentiate {node} with respect to {var}")
+                        derivative = self.sum_of(derivative, self.product_of(partial, d))
+            derivatives[id(node)] = derivative
+        return derivatives[id(self)]
+
+    def gradient(self, variables=None):
+        order = self.topological()
+        if variables is None:
+            variables = sorted({node.name for node in order if isinstance(node, Identifier)})
+        wanted = set(variables)
+        depends = set()
+        for node in order:
+            if isinstance(node, Identifier) and node.name in wanted or \
+               any(id(child) in depends for child in node.children()):
+                depends.add(id(node))
+
+        result = {name: Constant(0.0) for name in variables}
+        adjoints = {id(self): Constant(1.0)}
+        for node in reversed(order):
+            adjoint = adjoints.pop(id(node), None)
+            if adjoint is None or id(node) not in depends:
+                continue
+            if isinstance(node, Identifier):
+                result[node.name] = self.sum_of(result[node.name], adjoint)
+                continue
+            for child, partial in zip(node.children(), node.partials()):
+                if id(child) not in depends:
+                    continue
+                if partial is None:
+                    raise ValueError(f"cannot differentiate {node}")
+                contribution = self.product_of(adjoint, partial)
+                key = id(child)
+                adjoints[key] = self.sum_of(adjoints[key], contribution) if key in adjoints else contribution
+        return result
+
+    def evaluate_gradient(self, mapping):
+        order = self.topological()
+        values = {}
+        for node in order:
+            values[id(node)] = node.evaluate_local([values[id(child)] for child in node.children()], mapping)
+
+        result = dict.fromkeys(mapping, 0.0)
+        adjoints = {id(self): 1.0}
+        for node in reversed(order):
+            adjoint = adjoints.pop(id(node), None)
+            if adjoint is None:
+                continue
+            if isinstance(node, Identifier):
+                result[node.name] = result[node.name] + adjoint
+                continue
+            children = node.children()
+            partials = node.partial_values([values[id(child)] for child in children], values[id(node)])
+            for child, partial in zip(children, partials):
+                if partial is None or isinstance(child, Constant):
+                    continue
+                key = id(child)
+                adjoints[key] = adjoints[key] + adjoint * partial if key in adjoints else adjoint * partial
+        return values[id(self)], result
+
+    def check_gradient(self, mapping, step=1e-6):
+        _, gradient = self.evaluate_gradient(mapping)
+        errors = {}
+        for name, value in mapping.items():
+            upper = self.evaluate(dict(mapping, **{name: value + step}))
+            lower = self.evaluate(dict(mapping, **{name: value - step}))
+            errors[name] = np.max(np.abs(gradient[name] - (upper - lower) / (2 * step)))
+        return errors
+
+    def to_tape(self):
+        return Tape.from_expression(self)
+
+    def dumps(self):
+        return self.to_tape().serialize()
+
+    @classmethod
+    def loads(self, data, normal=False):
+        return Tape.deserialize(data).to_expression(normal)
+
+    BATCH_HEADER = struct.Struct('<4sBBI')
+    BATCH_MAGIC = b'EXPS'
+    BATCH_VERSION = 1
+    RECORD_HEADER = struct.Struct('<I')
+
+    @classmethod
+    def save(self, expressions, path, normal=False):
+        blobs = [expr.dumps() for expr in expressions]
+        with open(path, 'wb') as f:
+            f.write(self.BATCH_HEADER.pack(self.BATCH_MAGIC, self.BATCH_VERSION, int(normal), len(blobs)))
+            for blob in blobs:
+                f.write(self.RECORD_HEADER.pack(len(blob)))
+                f.write(blob)
+
+    @classmethod
+    def load(self, path):
+        with open(path, 'rb') as f:
+            data = memoryview(f.read())
+        magic, version, normal, count = self.BATCH_HEADER.unpack_from(data)
+        if magic != self.BATCH_MAGIC:
+            raise ValueError("not an expression batch file")
+        if version != self.BATCH_VERSION:
+            raise ValueError(f"unsupported batch version {version}")
+        offset = self.BATCH_HEADER.size
+        expressions = []
+        for i in range(count):
+            size, = self.RECORD_HEADER.unpack_from(data, offset)
+            offset += self.RECORD_HEADER.size
+            expressions.append(self.loads(data[offset:offset + size], bool(normal)))
+            offset += size
+        return expressions
+
+    @classmethod
+    def map_serialized(self, func, blobs, processes=None, chunksize=16):
+        if processes == 1:
+            return [func(blob) for blob in blobs]
+        with multiprocessing.Pool(processes) as pool:
+            return pool.map(func, blobs, chunksize)
+
+    @classmethod
+    def simplify_many(self, expressions, processes=None, chunksize=16):
+        blobs = self.map_serialized(simplify_serialized, [expr.dumps() for expr in expressions],
+                                    processes, chunksize)
+        return [self.loads(blob, normal=True) for blob in blobs]
+
     def linear(self, var):
         raise ValueError("non-linear")
     
 class Identifier(Expression):
 
+    NORMAL_FORM = True
+
+    __slots__ = ('name',)
+
     def __init__(self, name):
+        if self.initialized:
+            return
         self.name = name
 
     def __str__(self):
@@ -91,14 +596,34 @@ class Identifier(Expression):
     def __eq__(self, other):
         return type(self) is type(other) and \
             self.name == other.name
+
+    __hash__ = Expression.__hash__
+
+    def structure(self):
+        return (self.name,)
     
     def substitute(self, mapping):
         if self.name in mapping:
             return mapping[self.name]
         return super().substitute(mapping)
 
+    def partial_evaluate(self, mapping):
+        if self.name in mapping:
+            return Constant(mapping[self.name])
+        return self
+
     def evaluate(self, mapping):
         return mapping[self.name]
+
+    def evaluate_local(self, args, mapping):
+        return mapping[self.name]
+
+    def partials(self):
+        return ()
+
+    def compile_source(self, args, out, names):
+        names.add(self.name)
+        return 'v_' + self.name
     
     def linear(self, var):
         if self.name == var:
@@ -110,7 +635,13 @@ Expression.IDENTIFIER_FUNC = Identifier
 
 class Constant(Expression):
 
+    NORMAL_FORM = True
+
+    __slots__ = ('value',)
+
     def __init__(self, value):
+        if self.initialized:
+            return
         self.value = value
 
     def __str__(self):
@@ -120,12 +651,30 @@ class Constant(Expression):
         return type(self) is type(other) and \
             self.value == other.value
 
+    __hash__ = Expression.__hash__
+
+    def structure(self):
+        return (self.value,)
+
     def evaluate(self, mapping):
         return self.numeric()
+
+    def evaluate_local(self, args, mapping):
+        return self.value
+
+    def partials(self):
+        return ()
+
+    def compile_source(self, args, out, names):
+        value = float(self.value)
+        return repr(value) if math.isfinite(value) else f"float('{value}')"
     
     def numeric(self):
         return self.value
 
+    def polynomial(self):
+        return Polynomial.constant(self.value)
+
     def linear(self, var):
         return Constant(0), self
     
@@ -133,19 +682,28 @@ Expression.CONSTANT_FUNC = Constant
 
 class UnaryOp(Expression):
 
+    __slots__ = ('arg',)
+
     def __init__(self, arg):
+        if self.initialized:
+            return
         self.arg = arg
 
     def __str__(self):
         return f'{self.SYMBOL}({str(self.arg)})'
     def substitute(self, mapping):
-        return type(self)(self.arg.substitute(mapping))
+        arg = self.arg.substitute(mapping)
+        return self if arg is self.arg else type(self)(arg)
 
-    def __eq__(self, other):
-        return type(self) is type(other) and \
-            self.arg == other.arg
+    def partial_evaluate(self, mapping):
+        arg = self.arg.partial_evaluate(mapping)
+        node = self if arg is self.arg else type(self)(arg)
+        return node.fold() if isinstance(arg, Constant) else node
 
-    def simplify(self):
+    def structure(self):
+        return (self.arg,)
+
+    def simplify_tree(self):
         arg0 = self.arg.simplify()
         self0 = self if arg0 is self.arg else type(self)(arg0)
         self1 = self0.simplify_local()
@@ -153,29 +711,57 @@ class UnaryOp(Expression):
     
 class UnaryMinus(UnaryOp):
     SYMBOL = '-'
+    PYTHON_OP = '-'
+    NUMPY_OP = 'negative'
+    __slots__ = ()
 
     def simplify_local(self):
         return Multiplication(Constant(-1.0), self.arg)
+
+    def polynomial(self):
+        return -self.arg.polynomial()
     
     def evaluate(self, mapping):
         return -self.arg.evaluate(mapping)
 
+    def partials(self):
+        return (Constant(-1.0),)
+
+    def partial_values(self, args, value):
+        return (-1.0,)
+
 Expression.UNARY_OPS[UnaryMinus.SYMBOL] = (100, UnaryMinus)
 
 class UnaryPlus(UnaryOp):
     SYMBOL = '+'
+    PYTHON_OP = '+'
+    NUMPY_OP = 'positive'
+    __slots__ = ()
 
-    def simplify(self):
+    def simplify_tree(self):
         return self.arg.simplify()
 
+    def polynomial(self):
+        return self.arg.polynomial()
+
     def evaluate(self, mapping):
         return self.arg.evaluate(mapping)
+
+    def partials(self):
+        return (Constant(1.0),)
+
+    def partial_values(self, args, value):
+        return (1.0,)
     
 Expression.UNARY_OPS[UnaryPlus.SYMBOL] = (100, lambda x: x)
 
 class BinaryOp(Expression):
 
+    __slots__ = ('left', 'right')
+
     def __init__(self, left, right):
+        if self.initialized:
+            return
         self.left = left;
         self.right = right
 
@@ -183,14 +769,22 @@ class BinaryOp(Expression):
         return f'({str(self.left)}) {self.SYMBOL} ({str(self.right)})'
 
     def substitute(self, mapping):
-        return type(self)(self.left.substitute(mapping), self.right.substitute(mapping))
+        left = self.left.substitute(mapping)
+        right = self.right.substitute(mapping)
+        if left is self.left and right is self.right:
+            return self
+        return type(self)(left, right)
+
+    def partial_evaluate(self, mapping):
+        left = self.left.partial_evaluate(mapping)
+        right = self.right.partial_evaluate(mapping)
+        node = self if left is self.left and right is self.right else type(self)(left, right)
+        return node.fold() if isinstance(left, Constant) and isinstance(right, Constant) else node
     
-    def __eq__(self, other):
-        return type(self) is type(other) and \
-            self.left == other.left and \
-            self.right == other.right
+    def structure(self):
+        return (self.left, self.right)
 
-    def simplify(self):
+    def simplify_tree(self):
         left0 = self.left.simplify()
         right0 = self.right.simplify()
         self0 = self if left0 is self.left and right0 is self.right else type(self)(left0, right0)
@@ -206,6 +800,18 @@ class BinaryOp(Expression):
     
 class PowerOp(BinaryOp):
     SYMBOL = '^'
+    PYTHON_OP = '**'
+    NUMPY_OP = 'power'
+    __slots__ = ()
+
+    def compile_source(self, args, out, names):
+        # the ufuncs for common exponents are much faster than power()
+        special = {2: 'square', 0.5: 'sqrt', -1: 'reciprocal'}.get(self.right.numeric())
+        if special is not None:
+            return f"np.{special}({args[0]}{f', out={out}' if out else ''})"
+        if self.left.numeric() == 2:
+            return f"np.exp2({args[1]}{f', out={out}' if out else ''})"
+        return super().compile_source(args, out, names)
 
     def simplify_local(self):
         n1 = self.left.numeric()
@@ -216,6 +822,9 @@ class PowerOp(BinaryOp):
             return Constant(1)
         if n2 == 1:
             return self.left
+        if self.EXPAND_POLYNOMIALS and n2 is not None and n2 > 0 and n2 == int(n2) and \
+           isinstance(self.left, (Addition, Subtraction)):
+            return self.expand()
         if isinstance(self.left, Multiplication):
             return type(self.left)(type(self)(self.left.left, self.right), type(self)(self.left.right, self.right))
         if isinstance(self.left, PowerOp):
@@ -223,13 +832,42 @@ class PowerOp(BinaryOp):
 
         return self
 
+    def polynomial(self):
+        n = self.right.polynomial().numeric()
+        if n is None or n != int(n):
+            return super().polynomial()
+        base = self.left.polynomial()
+        if n >= 0:
+            return base ** int(n)
+        if len(base.terms) != 1:
+            return super().polynomial()
+        return base ** int(n)
+
     def evaluate(self, mapping):
         return self.left.evaluate(mapping) ** self.right.evaluate(mapping)
+
+    def partials(self):
+        # there is no logarithm in the language, so only the base can be differentiated
+        n = self.right.numeric()
+        if n is None:
+            return (Multiplication(self.right, PowerOp(self.left, Subtraction(self.right, Constant(1.0)))), None)
+        power = Constant(1.0) if n == 1 else self.left if n == 2 else PowerOp(self.left, Constant(n - 1.0))
+        return (self.product_of(Constant(n), power), None)
+
+    def partial_values(self, args, value):
+        base, exponent = args
+        if isinstance(self.right, Constant):
+            return (exponent * base ** (exponent - 1), None)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return (exponent * base ** (exponent - 1), value * np.log(base))
     
 Expression.BINARY_OPS[PowerOp.SYMBOL] = (100, False, PowerOp)
 
 class Multiplication(BinaryOp):
     SYMBOL = '*'
+    PYTHON_OP = '*'
+    NUMPY_OP = 'multiply'
+    __slots__ = ()
 
     def simplify_local(self):
         n1 = self.left.numeric()
@@ -242,6 +880,9 @@ class Multiplication(BinaryOp):
             return self.right
         if n2 == 1:
             return self.left
+        if self.EXPAND_POLYNOMIALS and \
+           (isinstance(self.left, (Addition, Subtraction)) or isinstance(self.right, (Addition, Subtraction))):
+            return self.expand()
         if isinstance(self.left, Addition) or \
            isinstance(self.left, Subtraction):
             return type(self.left)(type(self)(self.left.left, self.right), type(self)(self.left.right, self.right))
@@ -256,6 +897,18 @@ class Multiplication(BinaryOp):
         
         return self
 
+    def polynomial(self):
+        result = Polynomial.constant(1.0)
+        pending = [self]
+        while pending:
+            node = pending.pop()
+            if isinstance(node, Multiplication):
+                pending.append(node.right)
+                pending.append(node.left)
+            else:
+                result = result * node.polynomial()
+        return result
+
     def linear(self, var):
         k1, b1 = self.left.linear(var)
         k2, b2 = self.right.linear(var)
@@ -266,22 +919,46 @@ class Multiplication(BinaryOp):
     def evaluate(self, mapping):
         return self.left.evaluate(mapping) * self.right.evaluate(mapping)
 
+    def partials(self):
+        return (self.right, self.left)
+
+    def partial_values(self, args, value):
+        return (args[1], args[0])
+
 Expression.BINARY_OPS[Multiplication.SYMBOL] = (200, True, Multiplication)
 
 class Division(BinaryOp):
     SYMBOL = '/'
+    PYTHON_OP = '/'
+    NUMPY_OP = 'divide'
+    __slots__ = ()
 
     def simplify_local(self):
         return Multiplication(self.left,
                               PowerOp(self.right, Constant(-1.0)))
 
+    def polynomial(self):
+        right = self.right.polynomial()
+        if len(right.terms) != 1:
+            return self.left.polynomial() * Polynomial.atom(PowerOp(self.right, Constant(-1.0)))
+        return self.left.polynomial() * right ** -1
+
     def evaluate(self, mapping):
         return self.left.evaluate(mapping) / self.right.evaluate(mapping)
 
+    def partials(self):
+        return (Division(Constant(1.0), self.right), UnaryMinus(Division(self, self.right)))
+
+    def partial_values(self, args, value):
+        return (1.0 / args[1], -value / args[1])
+
 Expression.BINARY_OPS[Division.SYMBOL] = (200, True, Division)
 
 class Addition(BinaryOp):
     SYMBOL = '+'
+    PYTHON_OP = '+'
+    NUMPY_OP = 'add'
+    __slots__ = ()
 
     def simplify_local(self):
         n1 = self.left.numeric()
@@ -296,6 +973,18 @@ class Addition(BinaryOp):
             return Multiplication(Constant(2.0), self.left)
         return self
 
+    def polynomial(self):
+        result = Polynomial()
+        pending = [(self, 1.0)]
+        while pending:
+            node, sign = pending.pop()
+            if isinstance(node, (Addition, Subtraction)):
+                pending.append((node.left, sign))
+                pending.append((node.right, -sign if isinstance(node, Subtraction) else sign))
+            else:
+                result.accumulate(node.polynomial(), sign)
+        return result
+
     def linear(self, var):
         k1, b1 = self.left.linear(var)
         k2, b2 = self.right.linear(var)
@@ -303,11 +992,20 @@ class Addition(BinaryOp):
 
     def evaluate(self, mapping):
         return self.left.evaluate(mapping) + self.right.evaluate(mapping)
+
+    def partials(self):
+        return (Constant(1.0), Constant(1.0))
+
+    def partial_values(self, args, value):
+        return (1.0, 1.0)
         
 Expression.BINARY_OPS[Addition.SYMBOL] = (300, True, Addition)
 
 class Subtraction(BinaryOp):
     SYMBOL = '-'
+    PYTHON_OP = '-'
+    NUMPY_OP = 'subtract'
+    __slots__ = ()
 
     def simplify_local(self):
         n1 = self.left.numeric()
@@ -322,6 +1020,8 @@ class Subtraction(BinaryOp):
             return Constant(0.0)
         return self
 
+    polynomial = Addition.polynomial
+
     def linear(self, var):
         k1, b1 = self.left.linear(var)
         k2, b2 = self.right.linear(var)
@@ -329,11 +1029,18 @@ class Subtraction(BinaryOp):
 
     def evaluate(self, mapping):
         return self.left.evaluate(mapping) - self.right.evaluate(mapping)
+
+    def partials(self):
+        return (Constant(1.0), Constant(-1.0))
+
+    def partial_values(self, args, value):
+        return (1.0, -1.0)
     
 Expression.BINARY_OPS[Subtraction.SYMBOL] = (300, True, Subtraction)
 
 class Equation(BinaryOp):
     SYMBOL = '='
+    __slots__ = ()
 
     def solve(self, var):
         k1, b1 = self.left.simplify().linear(var)
@@ -341,8 +1048,216 @@ class Equation(BinaryOp):
         return type(self)(Identifier(var),
                           Division(Subtraction(b2, b1), Subtraction(k1, k2)).simplify())
 
+    @classmethod
+    def solve_many(self, equations, var, processes=None, chunksize=16):
+        blobs = self.map_serialized(solve_serialized, [(equation.dumps(), var) for equation in equations],
+                                    processes, chunksize)
+        return [self.loads(blob) for blob in blobs]
+
+    @classmethod
+    def solve_system(self, equations, variables):
+        columns = {var: j for j, var in enumerate(variables)}
+        matrix = np.zeros((len(equations), len(variables)))
+        rhs = np.zeros(len(equations))
+        for i, equation in enumerate(equations):
+            for monomial, coef in (equation.left.polynomial() - equation.right.polynomial()).terms.items():
+                if not monomial:
+                    rhs[i] -= coef
+                    continue
+                (atom, exponent), = monomial if len(monomial) == 1 else ((None, None),)
+                if exponent != 1 or not isinstance(atom, Identifier) or atom.name not in columns:
+                    term = Polynomial({monomial: coef}).to_expression()
+                    unknown = sorted({node.name for node in term.topological()
+                                      if isinstance(node, Identifier) and node.name not in columns})
+                    if unknown:
+                        raise ValueError(f"equation {i} has symbols that are not among the unknowns: "
+                                         f"{', '.join(unknown)} in term {term} (give them values with partial_evaluate or solve for them too)")
+                    raise ValueError(f"equation {i} is not linear in {', '.join(variables)}: term {term}")
+                matrix[i, columns[atom.name]] += coef
+
+        if matrix.shape[0] == matrix.shape[1]:
+            try:
+                solution = np.linalg.solve(matrix, rhs)
+            except np.linalg.LinAlgError:
+                rank = np.linalg.matrix_rank(matrix)
+                raise ValueError(f"singular system: rank {rank} < {len(variables)} unknowns") from None
+        else:
+            solution, residuals, rank, sv = np.linalg.lstsq(matrix, rhs, rcond=None)
+            if rank < len(variables):
+                raise ValueError(f"under-determined system: rank {rank} < {len(variables)} unknowns")
+            if not np.allclose(matrix @ solution, rhs):
+                raise ValueError("inconsistent system")
+        return [self(Identifier(var), Constant(float(value))) for var, value in zip(variables, solution)]
+
+    def expand(self):
+        return type(self)(self.left.expand(), self.right.expand())
+
     def plot(self, axes, r):
         eq0 = self.solve(axes.yaxis.axis_name)
-        return axes.plot(eq0.right.evaluate({axes.xaxis.axis_name: r}))
+        func = eq0.right.compile()
+        name = axes.xaxis.axis_name
+        if hasattr(axes, 'plot_function'):
+            return axes.plot_function(lambda x: func({name: x}), r)
+        return axes.plot(func({name: r}))
     
 Expression.BINARY_OPS[Equation.SYMBOL] = (400, False, Equation)
+
+class TapeBuilder:
+
+    # collects distinct tape entries, each (opcode, operand, operand) once
+
+    def __init__(self):
+        self.entries, self.names, self.constants = {}, {}, {}
+
+    def emit(self, op, left=0, right=0):
+        return self.entries.setdefault((op, left, right), len(self.entries))
+
+    def name(self, name):
+        return self.names.setdefault(name, len(self.names))
+
+    def constant(self, value):
+        return self.constants.setdefault(float(value), len(self.constants))
+
+    def copy(self, tape, index, replace=None):
+        # the entries of another tape up to index, with the identifiers
+        # that are keys of replace copied as the tapes they map to
+        remap, replaced = [], {}
+        for op, (left, right) in zip(tape.ops[:index + 1].tolist(), tape.args[:index + 1].tolist()):
+            cls = tape.OPCODES[op]
+            if cls is Identifier:
+                name = tape.names[left]
+                if replace and name in replace:
+                    if name not in replaced:
+                        replaced[name] = self.copy(replace[name], len(replace[name]) - 1)
+                    remap.append(replaced[name])
+                else:
+                    remap.append(self.emit(op, self.name(name)))
+            elif cls is Constant:
+                remap.append(self.emit(op, self.constant(tape.constants[left])))
+            elif issubclass(cls, UnaryOp):
+                remap.append(self.emit(op, remap[left]))
+            else:
+                remap.append(self.emit(op, remap[left], remap[right]))
+        return remap[-1]
+
+    def build(self):
+        entries = np.array(list(self.entries), dtype=np.uint32).reshape(-1, 3)
+        return Tape(entries[:, 0].astype(np.uint8), entries[:, 1:].copy(),
+                    list(self.names), np.array(list(self.constants), dtype=np.float64))
+
+class Tape:
+
+    # every distinct node is one entry: an opcode and two operands that are
+    # an index into the names or the constants for a leaf, and the indices of
+    # earlier entries for an operator (the unused operand is 0); the last
+    # entry is the root, so shared subtrees are stored once
+
+    MAGIC = b'EXPT'
+    VERSION = 2
+    HEADER = struct.Struct('<4sBIII')
+
+    OPCODES = [Identifier, Constant, UnaryMinus, UnaryPlus, PowerOp,
+               Multiplication, Division, Addition, Subtraction, Equation]
+    OPERATORS = {UnaryMinus: operator.neg, UnaryPlus: operator.pos, PowerOp: operator.pow,
+                 Multiplication: operator.mul, Division: operator.truediv,
+                 Addition: operator.add, Subtraction: operator.sub}
+
+    def __init__(self, ops, args, names, constants):
+        self.ops = ops
+        self.args = args
+        self.names = names
+        self.constants = constants
+
+    def __len__(self):
+        return len(self.ops)
+
+    @classmethod
+    def from_expression(self, expr):
+        opcodes = {cls: op for op, cls in enumerate(self.OPCODES)}
+        builder = TapeBuilder()
+        index = {}
+        for node in expr.topological():
+            if type(node) not in opcodes:
+                raise ValueError(f"cannot convert {type(node).__name__} to tape")
+            op = opcodes[type(node)]
+            if isinstance(node, Identifier):
+                index[id(node)] = builder.emit(op, builder.name(node.name))
+            elif isinstance(node, Constant):
+                index[id(node)] = builder.emit(op, builder.constant(node.value))
+            else:
+                index[id(node)] = builder.emit(op, *(index[id(child)] for child in node.structure()))
+        return builder.build()
+
+    def to_expression(self, normal=False):
+        nodes = []
+        for op, (left, right) in zip(self.ops.tolist(), self.args.tolist()):
+            cls = self.OPCODES[op]
+            if cls is Identifier:
+                node = Identifier(self.names[left])
+            elif cls is Constant:
+                node = Constant(float(self.constants[left]))
+            elif issubclass(cls, UnaryOp):
+                node = cls(nodes[left])
+            else:
+                node = cls(nodes[left], nodes[right])
+            if normal:
+                node.normal = True
+            nodes.append(node)
+        return nodes[-1]
+
+    def evaluate(self, mapping):
+        values = []
+        for op, (left, right) in zip(self.ops.tolist(), self.args.tolist()):
+            cls = self.OPCODES[op]
+            if cls is Identifier:
+                values.append(mapping[self.names[left]])
+            elif cls is Constant:
+                values.append(float(self.constants[left]))
+            elif cls not in self.OPERATORS:
+                raise ValueError("cannot evaluate")
+            elif issubclass(cls, UnaryOp):
+                values.append(self.OPERATORS[cls](values[left]))
+            else:
+                values.append(self.OPERATORS[cls](values[left], values[right]))
+        return values[-1]
+
+    def substitute(self, mapping):
+        tapes = {name: value if isinstance(value, Tape) else value.to_tape()
+                 for name, value in mapping.items()}
+        builder = TapeBuilder()
+        root = builder.copy(self, len(self) - 1, tapes)
+        if root != len(builder.entries) - 1:
+            # the root is an entry emitted earlier, copied again it comes last
+            builder, tape = TapeBuilder(), builder.build()
+            builder.copy(tape, root)
+        return builder.build()
+
+    def serialize(self):
+        names = '\0'.join(self.names).encode()
+        return b''.join([self.HEADER.pack(self.MAGIC, self.VERSION, len(self.ops), len(self.constants), len(names)),
+                         self.ops.tobytes(), self.args.astype('<u4').tobytes(),
+                         self.constants.astype('<f8').tobytes(), names])
+
+    @classmethod
+    def deserialize(self, data):
+        magic, version, n_ops, n_constants, n_names = self.HEADER.unpack_from(data)
+        if magic != self.MAGIC:
+            raise ValueError("not an expression tape")
+        if version != self.VERSION:
+            raise ValueError(f"unsupported tape version {version}")
+        offset = self.HEADER.size
+        ops = np.frombuffer(data, dtype=np.uint8, count=n_ops, offset=offset)
+        offset += n_ops
+        args = np.frombuffer(data, dtype='<u4', count=2 * n_ops, offset=offset).astype(np.uint32).reshape(-1, 2)
+        offset += 8 * n_ops
+        constants = np.frombuffer(data, dtype='<f8', count=n_constants, offset=offset).astype(np.float64)
+        offset += 8 * n_constants
+        names = bytes(data[offset:offset + n_names]).decode()
+        return self(ops.copy(), args, names.split('\0') if names else [], constants)
+
+def simplify_serialized(data):
+    return Expression.loads(data).simplify().dumps()
+
+def solve_serialized(args):
+    data, var = args
+    return Expression.loads(data).solve(var).dumps()
@@ -0,0 +1,135 @@
+import numpy as np
+
+class Axis:
+
+    def __init__(self, axis_name):
+        self.axis_name = axis_name
+
+class TextAxes:
+
+    FLAT = 0.01
+    SEGMENT = 0.9
+    SINGULAR_NUDGE = 0.1
+    REFINE_DEPTH = 4
+
+    def __init__(self, xname='x', yname='y', level=3):
+        self.xaxis = Axis(xname)
+        self.yaxis = Axis(yname)
+        self.level = level
+        self.lines = []
+
+    def plot(self, values):
+        raise ValueError("text axes need a function, use Equation.plot")
+
+    def plot_function(self, func, r):
+        r = np.asarray(r, dtype=float)
+        dx = r[1] - r[0] if len(r) > 1 else 1.0
+        self.lines = self.render(func, r[0], r[-1], dx)
+        return self.lines
+
+    def __str__(self):
+        return '\n'.join(self.lines) + '\n'
+
+    @staticmethod
+    def evaluate(func, x):
+        with np.errstate(all='ignore'):
+            return np.broadcast_to(np.asarray(func(x), dtype=float), np.shape(x)).copy()
+
+    def sample(self, func, xs, dx):
+        ys = self.evaluate(func, xs)
+        singular = ~np.isfinite(ys)
+        # only singular points are refined, by the closest finite value next to them
+        for nudge in (self.SINGULAR_NUDGE, -self.SINGULAR_NUDGE):
+            bad = ~np.isfinite(ys)
+            if not bad.any():
+                break
+            ys[bad] = self.evaluate(func, xs[bad] + nudge * dx)
+        return ys, singular
+
+    def refine(self, func, xs, ys, ends, dx):
+        # a segment covers the values between its ends too: the parts that change
+        # by more than a row or bend away from their chord are halved and sampled again,
+        # the columns that still need halving and have grown by a row at the last one are unsettled
+        low, high = np.fmin(ys, ends), np.fmax(ys, ends)
+        column = np.arange(len(xs))
+        left, right, fleft, fright = xs, xs + self.SEGMENT * dx, ys, ends
+        unsettled = np.zeros(len(xs), dtype=bool)
+        for depth in range(self.REFINE_DEPTH):
+            if not len(column):
+                break
+            before = high - low
+            middle = (left + right) / 2
+            fmiddle = self.evaluate(func, middle)
+            np.fmin.at(low, column, fmiddle)
+            np.fmax.at(high, column, fmiddle)
+            with np.errstate(invalid='ignore'):
+                grown = high - low > before + dx
+                steep = np.abs(fright - fleft) > dx
+                bent = np.abs(fmiddle - (fleft + fright) / 2) > dx / 2
+            split = steep | bent
+            column = np.concatenate([column[split], column[split]])
+            left, right = np.concatenate([left[split], middle[split]]), np.concatenate([middle[split], right[split]])
+            fleft, fright = np.concatenate([fleft[split], fmiddle[split]]), np.concatenate([fmiddle[split], fright[split]])
+            unsettled = np.zeros(len(xs), dtype=bool)
+            unsettled[column] = grown[column]
+        return low, high, unsettled
+
+    def classify(self, ys, singular, dx):
+        # ys and singular have one extra sample on each side of the canvas
+        before, current, after = ys[:-2], ys[1:-1], ys[2:]
+        with np.errstate(all='ignore'):
+            slope = np.select([singular[:-2], singular[2:]],
+                              [(after - current) / dx, (current - before) / dx],
+                              (after - before) / (2 * dx))
+        # no extremum is marked next to a singular point, the function does not turn there
+        ahead = np.where(singular[2:], np.nan, np.append(slope[1:], np.nan))
+        return np.select([singular[1:-1], (slope > 0) & (ahead < 0), (slope < 0) & (ahead > 0),
+                          np.abs(slope) < self.FLAT, slope > 0, slope < 0],
+                         ['|', '^', 'v', '-', '/', '\\'], '*')
+
+    def render(self, func, minx, maxx, dx):
+        n = int(np.floor((maxx - minx) / dx + 1e-9)) + 1
+        xs = minx + dx * np.arange(-1, n + 1)
+        around, singular = self.sample(func, xs, dx)
+        xs, ys = xs[1:-1], around[1:-1]
+        segments = self.level >= 2
+        # a segment stops short of the next sample so that it does not overlap the next column
+        ends = self.sample(func, xs + self.SEGMENT * dx, dx)[0] if segments else ys
+
+        finite = np.isfinite(ys) & np.isfinite(ends)
+        if not finite.any():
+            return []
+        known = np.concatenate([ys[finite], ends[finite]])
+        if segments:
+            # an unsettled column may hide a singular point, its values do not stretch the canvas
+            low, high, unsettled = self.refine(func, xs, ys, ends, dx)
+            settled = finite & ~unsettled
+            known = np.concatenate([known, low[settled], high[settled]])
+            low, high = np.clip(low, known.min(), known.max()), np.clip(high, known.min(), known.max())
+        else:
+            low = high = ys
+        if self.level == 0:
+            origin = np.floor(known.min() / dx + 1e-9) * dx
+            pos = np.rint((low - origin) / dx)
+            end = pos
+        else:
+            # rows are counted up from the lowest value
+            height = np.ceil((known.max() - known.min()) / dx - 1e-9)
+            pos = height - np.rint((high - known.min()) / dx)
+            end = height - np.rint((low - known.min()) / dx)
+
+        if self.level >= 3:
+            chars = self.classify(around, singular, dx)
+        else:
+            chars = np.full(n, '*')
+        lo = np.where(finite, np.minimum(pos, end), -1).astype(int)
+        hi = np.where(finite, np.maximum(pos, end), -2).astype(int)
+
+        size = hi.max() + 1
+        cells = np.arange(size)[:, None]
+        mask = (cells >= lo) & (cells <= hi)
+        grid = np.where(mask, chars, ' ').astype('<U1')
+        if self.level == 0:
+            grid = np.ascontiguousarray(grid.T)
+            return [line.rstrip() for line in grid.view(f'<U{size}')[:, 0].tolist()]
+        return grid.view(f'<U{n}')[:, 0].tolist()